@@ -0,0 +1,252 @@
+import asyncio
+import logging
+import time
+import aiohttp
+from config import get_tmdb_config
+from tmdb_cache import get_response_cache
+from urllib.parse import urlparse
+from utils import async_call_with_retry, CircuitOpenError
+from metrics import registry, observe_http
+
+logging.basicConfig(level=logging.INFO)
+
+# TMDB allows roughly 50 requests per second and 20 connections per IP; stay a little under both
+DEFAULT_RATE_LIMIT = 40
+DEFAULT_MAX_CONCURRENCY = 20
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_CERTIFICATION_COUNTRY = 'US'
+# Sub-request appended to a details call to get each media type's age certifications
+CERTIFICATION_APPENDS = {'movie': 'release_dates', 'tv': 'content_ratings'}
+
+def recommendation_result(rec, media_type):
+    """The fields kept from one entry of a recommendations response; movies carry 'title', TV shows 'name'."""
+    return {
+        'title': rec.get('title') or rec.get('name'),
+        'tmdb_id': rec.get('id'),
+        'media_type': rec.get('media_type') or media_type,
+        'release_date': rec.get('release_date') or rec.get('first_air_date') or None,
+        'popularity': rec.get('popularity')
+    }
+
+def certification_from_details(details, media_type, country=DEFAULT_CERTIFICATION_COUNTRY):
+    """Pick `country`'s certification out of a details response with release_dates or content_ratings appended."""
+    if media_type == 'movie':
+        for entry in (details.get('release_dates') or {}).get('results', []):
+            if entry.get('iso_3166_1') == country:
+                for release in entry.get('release_dates', []):
+                    if release.get('certification'):
+                        return release['certification']
+    else:
+        for entry in (details.get('content_ratings') or {}).get('results', []):
+            if entry.get('iso_3166_1') == country and entry.get('rating'):
+                return entry['rating']
+    return None
+
+class TokenBucket:
+    """Async token bucket handing out `rate` tokens per second with bursts of up to `capacity`."""
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Stop handing out tokens for `seconds`, e.g. after a 429 with Retry-After."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        """Wait until a token is available and take it."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class AsyncTMDBClient:
+    """
+    The application's TMDB client; every TMDB lookup goes through it.
+    Requests run with bounded concurrency behind a shared token bucket and the host's circuit breaker,
+    and 429 responses pause every worker for the server's Retry-After before the request is retried.
+    Identical requests made while one is already in flight (the same show in two libraries, the same
+    id reached from several items) wait for that request instead of sending their own.
+    """
+    def __init__(self, base_url=None, api_key=None, rate_limit=None, max_concurrency=None, max_retries=None,
+                 fetch_certifications=None):
+        tmdb = get_tmdb_config()
+        self.api_key = api_key or tmdb.get('api_key')
+        if not self.api_key:
+            logging.error("TMDB API key missing in configuration.")
+            raise ValueError("TMDB configuration error")
+        self.base_url = (base_url or tmdb.get('url') or 'https://api.themoviedb.org/3').rstrip('/')
+        self.host = urlparse(self.base_url).netloc
+        self.base_path = urlparse(self.base_url).path
+        self.rate_limit = float(rate_limit or tmdb.get('rate_limit', DEFAULT_RATE_LIMIT))
+        self.max_concurrency = int(max_concurrency or tmdb.get('max_concurrency', DEFAULT_MAX_CONCURRENCY))
+        self.max_retries = int(max_retries if max_retries is not None else tmdb.get('max_retries', DEFAULT_MAX_RETRIES))
+        self.fetch_certifications = tmdb.get('fetch_certifications', True) if fetch_certifications is None else fetch_certifications
+        self.certification_country = str(tmdb.get('certification_country') or DEFAULT_CERTIFICATION_COUNTRY).upper()
+        self.certifications = {}  # (media type, TMDB id) -> certification or None, kept for the client's lifetime
+        self.cache = get_response_cache()
+        self.session = None
+        self.bucket = None
+        self.semaphore = None
+        self.in_flight = {}  # cache key -> task fetching it
+        self.coalesced = 0
+
+    async def __aenter__(self):
+        # Loop-bound primitives are created here so the client can be reused across asyncio.run calls
+        self.bucket = TokenBucket(self.rate_limit)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.in_flight = {}
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.session = None
+
+    async def _get_json(self, path, params=None):
+        """
+        GET a TMDB endpoint through the response cache, retrying 429, 5xx and transport errors. Returns the JSON or None.
+        A caller asking for a request that is already in flight shares its result.
+        """
+        key = self.cache.make_key(path, params)
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            registry.inc('tmdb_coalesced_requests_total', kind=self.cache.endpoint_kind(path),
+                         help="TMDB lookups answered by an identical request already in flight.")
+            # Shielded so one waiter being cancelled doesn't cancel the request for the others
+            return await asyncio.shield(task)
+
+        cached = self.cache.get(path, params)
+        if cached is not None:
+            return cached
+        task = asyncio.ensure_future(self._fetch(path, params))
+        self.in_flight[key] = task
+        task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(self, path, params):
+        try:
+            data = await async_call_with_retry(self._request, path, params, host=self.host, retries=self.max_retries,
+                                               on_retry=self._on_retry)
+        except (aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError, ValueError) as e:
+            logging.error(f"TMDB API request error for {path}: {e}")
+            return None
+        self.cache.set(path, params, data)
+        return data
+
+    async def _request(self, path, params):
+        """One rate-limited GET; raises aiohttp.ClientResponseError for any non-2xx status."""
+        await self.bucket.acquire()
+        async with self.semaphore:
+            # Timed after the rate limiter and semaphore, so the histogram shows TMDB's latency and not our queueing
+            started = time.perf_counter()
+            try:
+                async with self.session.get(f"{self.base_url}{path}", params=dict(params or {}, api_key=self.api_key)) as response:
+                    observe_http(self.host, self.base_path + path, response.status, time.perf_counter() - started)
+                    response.raise_for_status()
+                    return await response.json()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                observe_http(self.host, self.base_path + path, type(e).__name__, time.perf_counter() - started)
+                raise
+
+    def _on_retry(self, error, delay):
+        # A 429 means every worker is over budget, not just this one
+        if getattr(error, 'status', None) == 429:
+            logging.warning(f"TMDB rate limit hit, pausing all requests for {delay:.1f}s")
+            self.bucket.pause(delay)
+
+    async def resolve_tmdb_id(self, title, media_type='movie'):
+        """Search TMDB for a title and return the first result's ID, or None."""
+        media_type = 'movie' if media_type == 'movie' else 'tv'
+        search = await self._get_json(f"/search/{media_type}", {'query': title})
+        results = (search or {}).get('results', [])
+        if not results:
+            logging.warning(f"No TMDB results for '{title}'")
+            return None
+        return results[0].get('id')
+
+    async def get_recommendations(self, title, media_type='movie', tmdb_id=None):
+        """
+        Fetch recommendations for a single title, skipping the search when the TMDB id is known.
+        Returns dicts with the recommended title, its TMDB id and media type, release or first air date and popularity.
+        """
+        media_type = 'movie' if media_type == 'movie' else 'tv'
+        tmdb_id = tmdb_id or await self.resolve_tmdb_id(title, media_type)
+        if not tmdb_id:
+            return []
+
+        data = await self._get_json(f"/{media_type}/{tmdb_id}/recommendations")
+        recommendations = (data or {}).get('results', [])
+        logging.info(f"Retrieved {len(recommendations)} recommendations for TMDB ID {tmdb_id}")
+        results = (recommendation_result(rec, media_type) for rec in recommendations)
+        return [result for result in results if result['title']]
+
+    async def get_certification(self, media_type, tmdb_id):
+        """A title's age certification in the configured country, from one details call with the ratings appended."""
+        key = (media_type, tmdb_id)
+        if key not in self.certifications:
+            details = await self._get_json(f"/{media_type}/{tmdb_id}", {'append_to_response': CERTIFICATION_APPENDS[media_type]})
+            if details is None:
+                # Not remembered, so a later batch can try again
+                return None
+            self.certifications[key] = certification_from_details(details, media_type, self.certification_country)
+        return self.certifications[key]
+
+    async def certifications_many(self, recommendations):
+        """
+        Set 'age_rating' on recommendation rows ('recommended_type' and 'tmdb_id'), looking up each distinct
+        title once however many rows and items share it. Returns the rows.
+        """
+        if not self.fetch_certifications:
+            return recommendations
+        keys = list({(rec.get('recommended_type'), rec.get('tmdb_id')) for rec in recommendations
+                     if rec.get('tmdb_id') and rec.get('recommended_type') in CERTIFICATION_APPENDS})
+        ratings = dict(zip(keys, await asyncio.gather(*(self.get_certification(*key) for key in keys))))
+        for rec in recommendations:
+            rec['age_rating'] = ratings.get((rec.get('recommended_type'), rec.get('tmdb_id')))
+        return recommendations
+
+    async def recommendations_many(self, items):
+        """
+        Fetch recommendations for many media items concurrently. Returns {item id: [recommendation dicts]}.
+        Items without a 'tmdb_id' are resolved by title search and the ID found is written back to the item.
+        """
+        async def fetch(item):
+            if not item.get('tmdb_id'):
+                item['tmdb_id'] = await self.resolve_tmdb_id(item['title'], item['type'])
+                if not item['tmdb_id']:
+                    return item['id'], []
+            return item['id'], await self.get_recommendations(item['title'], item['type'], item['tmdb_id'])
+        return dict(await asyncio.gather(*(fetch(item) for item in items)))
+
+    def get_recommendations_many(self, items):
+        """Blocking batch API: fetch recommendations for `items` (dicts with id, title, type and optional tmdb_id)."""
+        async def run():
+            async with self:
+                return await self.recommendations_many(items)
+        return asyncio.run(run())
+
+    def get_certifications_many(self, recommendations):
+        """Blocking form of certifications_many."""
+        async def run():
+            async with self:
+                return await self.certifications_many(recommendations)
+        return asyncio.run(run())
+
+    def get_recommendations_for_titles(self, titles, media_type='movie'):
+        """Blocking API for plain titles: returns {title: [recommendations]}, searching TMDB for each title once."""
+        items = [{'id': title, 'title': title, 'type': media_type, 'tmdb_id': None} for title in dict.fromkeys(titles)]
+        return self.get_recommendations_many(items)
@@ -0,0 +1,444 @@
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import socketserver
+import subprocess
+import sys
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Library sizes selectable on the command line
+LIBRARY_SIZES = {'1k': 1000, '10k': 10000, '100k': 100000}
+# Share of items in the movie folder (the rest are series), and of items Jellyfin knows a TMDB id for
+MOVIE_SHARE = 0.6
+TMDB_ID_SHARE = 0.8
+RECOMMENDATIONS_PER_TITLE = 20
+TMDB_ID_OFFSET = 100000
+# Certifications the stub hands out, cycling by TMDB id
+STUB_CERTIFICATIONS = {'movie': ('G', 'PG', 'PG-13', 'R'), 'tv': ('TV-Y', 'TV-PG', 'TV-14', 'TV-MA')}
+
+class SyntheticLibrary:
+    """
+    Deterministic fake Jellyfin library of `size` items split over a movie and a series folder.
+    TMDB recommendations are drawn from a catalogue twice the library's size, so about half of them are owned.
+    """
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.seed = seed
+        movies = int(size * MOVIE_SHARE)
+        self.folders = [
+            {'Id': 'folder-movies', 'Name': 'Movies', 'CollectionType': 'movies'},
+            {'Id': 'folder-tvshows', 'Name': 'Shows', 'CollectionType': 'tvshows'}
+        ]
+        self.items = {'folder-movies': [], 'folder-tvshows': []}
+        self.tmdb_ids = {}  # (media type, title) -> TMDB id, for the search endpoint
+        rng = random.Random(seed)
+        for number in range(size):
+            is_movie = number < movies
+            title = self.title(number, is_movie)
+            tmdb_id = TMDB_ID_OFFSET + number
+            self.tmdb_ids[('movie' if is_movie else 'tv', title.lower())] = tmdb_id
+            item = {
+                'Name': title,
+                'Id': f"item-{number:06d}",
+                'Type': 'Movie' if is_movie else 'Series',
+                'CommunityRating': round(rng.uniform(4, 9.5), 1) if rng.random() < 0.9 else None,
+                # Seven fractional digits, as Jellyfin writes them
+                'DateLastSaved': f"2024-01-01T00:00:{number % 60:02d}.{number % 10000000:07d}Z",
+                'ProviderIds': {'Tmdb': str(tmdb_id)} if rng.random() < TMDB_ID_SHARE else {}
+            }
+            self.items['folder-movies' if is_movie else 'folder-tvshows'].append(item)
+
+    @staticmethod
+    def title(number, is_movie):
+        return f"{'Movie' if is_movie else 'Show'} {number:06d}"
+
+    def recommendations(self, media_type, tmdb_id):
+        """TMDB-style recommendation results for a title, stable for a given id."""
+        rng = random.Random(tmdb_id)
+        key = 'title' if media_type == 'movie' else 'name'
+        numbers = rng.sample(range(self.size * 2), min(RECOMMENDATIONS_PER_TITLE, self.size * 2))
+        date_key = 'release_date' if media_type == 'movie' else 'first_air_date'
+        return [{'id': TMDB_ID_OFFSET + number, key: self.title(number, media_type == 'movie'), 'media_type': media_type,
+                 date_key: f"{1980 + number % 45}-{number % 12 + 1:02d}-{number % 28 + 1:02d}",
+                 'popularity': round(rng.uniform(1, 100), 2)} for number in numbers]
+
+    @staticmethod
+    def details(media_type, tmdb_id, append):
+        """TMDB-style details with release_dates or content_ratings appended; one title in ten is unrated."""
+        certifications = STUB_CERTIFICATIONS[media_type]
+        certification = certifications[tmdb_id % len(certifications)] if tmdb_id % 10 else ''
+        data = {'id': tmdb_id}
+        if append == 'release_dates':
+            data['release_dates'] = {'results': [{'iso_3166_1': 'US', 'release_dates': [{'certification': certification, 'type': 3}]}]}
+        elif append == 'content_ratings':
+            data['content_ratings'] = {'results': [{'iso_3166_1': 'US', 'rating': certification}] if certification else []}
+        return data
+
+class StubStats:
+    """Thread-safe request counters kept by every stub server."""
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, amount=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+class StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, library, latency=0.0, jitter=0.0, error_rate=0.0, rate_429=0.0, retry_after=0.1, seed=0):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.library = library
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.stats = StubStats()
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Clients closing idle keep-alive connections isn't worth a traceback
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    def roll(self):
+        """Latency to inject and the fault ('429', '500' or None) for the next request."""
+        with self.rng_lock:
+            delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+            draw = self.rng.random()
+        if draw < self.rate_429:
+            return delay, '429'
+        if draw < self.rate_429 + self.error_rate:
+            return delay, '500'
+        return delay, None
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real services, so clients reuse pooled connections
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        delay, fault = self.server.roll()
+        if delay:
+            time.sleep(delay)
+        if fault == '429':
+            self._reply(429, {'status_message': 'Too many requests'}, {'Retry-After': str(self.server.retry_after)})
+        elif fault == '500':
+            self._reply(500, {'status_message': 'Injected error'})
+        else:
+            status, body = self.route(parsed.path, query)
+            self._reply(status, body)
+
+    def route(self, path, query):
+        return 404, {'status_message': 'Not found'}
+
+    def _reply(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.server.stats.add(f"status_{status}")
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+class JellyfinStubHandler(StubHandler):
+    """Serves /Library/MediaFolders and paged /Items from a SyntheticLibrary."""
+    def route(self, path, query):
+        library = self.server.library
+        if path == '/Library/MediaFolders':
+            self.server.stats.add('media_folders')
+            return 200, {'Items': library.folders, 'TotalRecordCount': len(library.folders)}
+        if path == '/Items':
+            self.server.stats.add('items')
+            items = library.items.get(query.get('ParentId'), [])
+            since = query.get('MinDateLastSaved')
+            if since:
+                # Compared at the microsecond precision the client sends
+                items = [item for item in items if item['DateLastSaved'][:26] + 'Z' > since]
+            start = int(query.get('StartIndex', 0))
+            page = items[start:start + int(query.get('Limit', 100))]
+            body = {'Items': page}
+            if query.get('EnableTotalRecordCount') == 'true':
+                body['TotalRecordCount'] = len(items)
+            return 200, body
+        return super().route(path, query)
+
+class TMDBStubHandler(StubHandler):
+    """Serves /3/search/{movie,tv}, /3/{movie,tv}/{id} and /3/{movie,tv}/{id}/recommendations from a SyntheticLibrary."""
+    def route(self, path, query):
+        library = self.server.library
+        parts = path.strip('/').split('/')
+        if len(parts) == 3 and parts[:2] == ['3', 'search'] and parts[2] in ('movie', 'tv'):
+            self.server.stats.add('search')
+            tmdb_id = library.tmdb_ids.get((parts[2], query.get('query', '').lower()))
+            key = 'title' if parts[2] == 'movie' else 'name'
+            return 200, {'page': 1, 'results': [{'id': tmdb_id, key: query.get('query')}] if tmdb_id else []}
+        if len(parts) == 4 and parts[0] == '3' and parts[1] in ('movie', 'tv') and parts[3] == 'recommendations':
+            self.server.stats.add('recommendations')
+            results = library.recommendations(parts[1], int(parts[2]))
+            return 200, {'page': 1, 'results': results, 'total_pages': 1, 'total_results': len(results)}
+        if len(parts) == 3 and parts[0] == '3' and parts[1] in ('movie', 'tv') and parts[2].isdigit():
+            self.server.stats.add('details')
+            return 200, library.details(parts[1], int(parts[2]), query.get('append_to_response'))
+        return super().route(path, query)
+
+class SMTPStubServer(socketserver.ThreadingTCPServer):
+    """Minimal plaintext SMTP sink: accepts every message and counts messages and bytes."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPStubHandler)
+        self.stats = StubStats()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='SMTPStubServer', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class SMTPStubHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode('ascii'))
+
+    def handle(self):
+        self.reply("220 stub ESMTP ready")
+        for raw in self.rfile:
+            command = raw.decode('utf-8', 'replace').strip().upper()
+            if command.startswith('EHLO'):
+                self.wfile.write(b"250-stub\r\n250 8BITMIME\r\n")
+            elif command.startswith(('HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP')):
+                self.reply("250 OK")
+            elif command == 'DATA':
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for line in self.rfile:
+                    if line in (b".\r\n", b".\n"):
+                        break
+                    size += len(line)
+                self.server.stats.add('messages')
+                self.server.stats.add('bytes', size)
+                self.reply("250 OK: queued")
+            elif command == 'QUIT':
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+def configure_app(workdir, jellyfin_url, tmdb_url, smtp_port, tmdb_rate_limit, shards=1):
+    """
+    Point the application's configuration at the stubs and a scratch database before anything reads it
+    (database.py builds its engine on first use).
+    """
+    import config
+    config.config_data.setdefault('jellyfin', {}).update({'url': jellyfin_url, 'api_key': 'benchmark'})
+    config.config_data.setdefault('tmdb', {}).update({
+        'url': f"{tmdb_url}/3", 'api_key': 'benchmark', 'rate_limit': tmdb_rate_limit,
+        'cache': {'path': os.path.join(workdir, 'tmdb_cache.db')}
+    })
+    config.config_data['database'] = {'url': f"sqlite:///{os.path.join(workdir, 'benchmark.db')}", 'echo': False}
+    config.config_data['recommendations'] = dict(config.config_data.get('recommendations') or {},
+                                                 shards=shards, shard_dir=os.path.join(workdir, 'shards'))
+    config.config_data.setdefault('email', {}).update({
+        'smtp_server': '127.0.0.1', 'smtp_port': smtp_port, 'use_tls': False, 'password': '',
+        'sender': 'benchmark@localhost', 'notification_threshold': 1,
+        'recipient_groups': {'all_ages': ['all@localhost'], 'teen': ['teen@localhost'], 'adult': ['adult@localhost']}
+    })
+
+def table_counts():
+    """Row counts of the tables the pipeline writes."""
+    from sqlalchemy import text
+    from database import get_engine
+    with get_engine().connect() as conn:
+        return {table: conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+                for table in ('media_items', 'recommendations', 'recommendation_scores')}
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def measure(name, func, servers):
+    """Run one stage and return its wall time, request rate, rows written per second and peak RSS so far."""
+    before_requests = {key: server.stats.snapshot() for key, server in servers.items()}
+    before_rows = table_counts()
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    after_rows = table_counts()
+
+    requests = {}
+    for key, server in servers.items():
+        after = server.stats.snapshot()
+        requests[key] = {counter: after[counter] - before_requests[key].get(counter, 0)
+                         for counter in after if after[counter] != before_requests[key].get(counter, 0)}
+    http_requests = sum(count for key in ('jellyfin', 'tmdb') for counter, count in requests[key].items()
+                        if counter.startswith('status_'))
+    rows = {table: after_rows[table] - before_rows[table] for table in after_rows}
+    report = {
+        'wall_seconds': round(elapsed, 3),
+        'requests': requests,
+        'requests_per_second': round(http_requests / elapsed, 1) if elapsed else None,
+        'rows_written': rows,
+        'rows_per_second': round(sum(max(delta, 0) for delta in rows.values()) / elapsed, 1) if elapsed else None,
+        'peak_rss_mb': peak_rss_mb()
+    }
+    if isinstance(result, dict):
+        report['result'] = result
+    logging.info(f"Benchmark stage {name}: {report['wall_seconds']}s")
+    return report
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def run_benchmark(size, mode='pipeline', latency=0.02, jitter=0.005, error_rate=0.0, rate_429=0.0, retry_after=0.1,
+                  tmdb_rate_limit=1000, seed=0, shards=1, keep_workdir=False):
+    """
+    Run the sync -> recommend -> digest path once against local stubs and return a JSON-serialisable report.
+    Must run in a fresh process: the application modules are imported after the configuration is redirected.
+    The scratch directory with the run's databases is removed afterwards unless `keep_workdir` is set.
+    """
+    workdir = tempfile.mkdtemp(prefix='phantom-benchmark-')
+    started = time.perf_counter()
+    library = SyntheticLibrary(size, seed)
+    generate_seconds = time.perf_counter() - started
+
+    jellyfin = StubHTTPServer(JellyfinStubHandler, library, latency=latency, jitter=jitter, seed=seed).start()
+    tmdb = StubHTTPServer(TMDBStubHandler, library, latency=latency, jitter=jitter, error_rate=error_rate,
+                          rate_429=rate_429, retry_after=retry_after, seed=seed + 1).start()
+    smtp = SMTPStubServer().start()
+    servers = {'jellyfin': jellyfin, 'tmdb': tmdb, 'smtp': smtp}
+    try:
+        configure_app(workdir, jellyfin.url, tmdb.url, smtp.port, tmdb_rate_limit, shards)
+        import main
+        from utils import retry_metrics
+        from tmdb_cache import get_response_cache
+
+        stages = {}
+        if mode == 'pipeline':
+            from pipeline import run_pipeline
+            stages['pipeline'] = measure('pipeline', lambda: run_pipeline(full_sync=True), servers)
+        else:
+            stages['library_sync'] = measure('library_sync', lambda: main.fetch_and_store_media(full_sync=True), servers)
+            stages['recommendations'] = measure('recommendations', main.fetch_and_store_recommendations, servers)
+        stages['digest'] = measure('digest', main.send_notifications, servers)
+
+        return {
+            'commit': git_commit(),
+            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'python': sys.version.split()[0],
+            'size': size,
+            'mode': mode,
+            'shards': shards,
+            'stub': {'latency': latency, 'jitter': jitter, 'error_rate': error_rate, 'rate_429': rate_429,
+                     'retry_after': retry_after, 'tmdb_rate_limit': tmdb_rate_limit, 'seed': seed},
+            'generate_seconds': round(generate_seconds, 3),
+            'stages': stages,
+            'total_seconds': round(sum(stage['wall_seconds'] for stage in stages.values()), 3),
+            'peak_rss_mb': peak_rss_mb(),
+            'tmdb_cache': get_response_cache().stats(),
+            'retries': retry_metrics()
+        }
+    finally:
+        for server in servers.values():
+            server.stop()
+        if keep_workdir:
+            print(f"Benchmark databases kept in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def parse_size(value):
+    if value in LIBRARY_SIZES:
+        return LIBRARY_SIZES[value]
+    return int(value)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline offline against local Jellyfin, TMDB and SMTP stubs.")
+    parser.add_argument('--size', nargs='+', default=['1k'], help="Library sizes: 1k, 10k, 100k or a number of items.")
+    parser.add_argument('--mode', choices=['pipeline', 'stages'], default='pipeline',
+                        help="Run the concurrent pipeline, or the library sync and recommendation stages one after another.")
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds of latency added to every stub HTTP response.")
+    parser.add_argument('--jitter', type=float, default=0.005, help="Random +/- seconds around the latency.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of TMDB responses answered with a 500.")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="Share of TMDB responses answered with a 429.")
+    parser.add_argument('--retry-after', type=float, default=0.1, help="Retry-After seconds sent with injected 429s.")
+    parser.add_argument('--tmdb-rate-limit', type=float, default=1000, help="Client-side TMDB requests per second.")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="Split the recommendation stage across this many worker processes (stages mode only).")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Write the JSON report(s) to this file as well as stdout.")
+    parser.add_argument('--keep-workdir', action='store_true',
+                        help="Keep each run's scratch directory (databases and TMDB cache) and print its path.")
+    args = parser.parse_args()
+    if args.shards > 1 and args.mode != 'stages':
+        parser.error("--shards needs --mode stages; the pipeline runs its TMDB lookups in-process")
+
+    options = ['--mode', args.mode, '--shards', str(args.shards), '--latency', str(args.latency), '--jitter', str(args.jitter),
+               '--error-rate', str(args.error_rate), '--rate-429', str(args.rate_429),
+               '--retry-after', str(args.retry_after), '--tmdb-rate-limit', str(args.tmdb_rate_limit), '--seed', str(args.seed)]
+    if args.keep_workdir:
+        options.append('--keep-workdir')
+    if len(args.size) > 1:
+        # One process per size so module state and peak RSS don't carry over between runs
+        reports = []
+        for size in args.size:
+            completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--size', size] + options,
+                                       stdout=subprocess.PIPE, text=True, check=True)
+            reports.append(json.loads(completed.stdout))
+        output = json.dumps(reports, indent=2)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+        report = run_benchmark(parse_size(args.size[0]), mode=args.mode, latency=args.latency, jitter=args.jitter,
+                               error_rate=args.error_rate, rate_429=args.rate_429, retry_after=args.retry_after,
+                               tmdb_rate_limit=args.tmdb_rate_limit, seed=args.seed, shards=args.shards,
+                               keep_workdir=args.keep_workdir)
+        output = json.dumps(report, indent=2)
+
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + "\n")
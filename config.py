@@ -1,6 +1,6 @@
 import os
-import yaml
 import logging
+import threading
 
 # Environment setup and logging
 ENV = os.getenv("APP_ENV", "development")
@@ -8,6 +8,14 @@ CONFIG_PATHS = {
     "development": "config/dev_config.yaml",
     "production": "config/prod_config.yaml"
 }
+# Settings the pipeline can't run without, per section
+REQUIRED_SETTINGS = {
+    "jellyfin": ("url", "api_key"),
+    "tmdb": ("api_key",),
+    "email": ("smtp_server", "smtp_port", "sender", "recipient_groups")
+}
+# Optional sections; when present they must be mappings
+OPTIONAL_SECTIONS = ("database", "scheduler", "pipeline", "recommendations", "metrics")
 
 def load_config():
     """Load configuration based on the environment."""
@@ -15,14 +23,57 @@ def load_config():
     if not config_path or not os.path.exists(config_path):
         raise FileNotFoundError(f"Configuration file for {ENV} environment not found.")
 
+    # Imported on first load so importing this module stays cheap
+    import yaml
     with open(config_path, 'r') as file:
-        return yaml.safe_load(file)
+        return yaml.safe_load(file) or {}
+
+def validate_config(data):
+    """Return a list of problems with the configuration: missing sections, unset required settings, wrong types."""
+    problems = []
+    if not isinstance(data, dict):
+        return ["Configuration file is not a mapping of sections."]
+    for section, keys in REQUIRED_SETTINGS.items():
+        values = data.get(section)
+        if not isinstance(values, dict):
+            problems.append(f"Missing '{section}' section in configuration.")
+            continue
+        problems.extend(f"'{section}.{key}' is not set." for key in keys if values.get(key) in (None, ''))
+    problems.extend(f"'{section}' section must be a mapping." for section in OPTIONAL_SECTIONS
+                    if section in data and not isinstance(data[section], (dict, type(None))))
+    return problems
+
+# Loaded and validated on first use rather than at import
+_config_data = None
+_config_lock = threading.Lock()
+
+def get_config():
+    """Return the whole configuration, loading and validating it the first time it's needed."""
+    global _config_data
+    if _config_data is None:
+        with _config_lock:
+            if _config_data is None:
+                data = load_config()
+                for problem in validate_config(data):
+                    logging.warning(problem)
+                _config_data = data
+    return _config_data
+
+def set_config(data):
+    """Use an already loaded configuration instead of reading the file, e.g. the parent's in a worker process."""
+    global _config_data
+    with _config_lock:
+        _config_data = data
 
-# Global config variable
-config_data = load_config()
+def __getattr__(name):
+    # Keeps `config.config_data` working without loading the file at import time
+    if name == "config_data":
+        return get_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def get_section(section):
     """Retrieve a section of the configuration."""
+    config_data = get_config()
     if section not in config_data:
         logging.error(f"Missing '{section}' section in configuration.")
     return config_data.get(section, {})
@@ -36,3 +87,23 @@ def get_tmdb_config():
 
 def get_email_config():
     return get_section("email")
+
+def get_database_config():
+    # Optional section; database.py falls back to the local SQLite file
+    return get_config().get("database") or {}
+
+def get_scheduler_config():
+    # Optional section; scheduler.py has defaults for every interval
+    return get_config().get("scheduler") or {}
+
+def get_pipeline_config():
+    # Optional section; pipeline.py has defaults for queue sizes and worker counts
+    return get_config().get("pipeline") or {}
+
+def get_recommendations_config():
+    # Optional section; owned_index.py filters owned titles by default and fuzzy matching is off
+    return get_config().get("recommendations") or {}
+
+def get_metrics_config():
+    # Optional section; without it no metrics file is written and profiling stays off
+    return get_config().get("metrics") or {}
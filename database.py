@@ -1,15 +1,53 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import (create_engine, event, exists, func, inspect, select, text, case, literal, Column, Integer, Float,
+                        String, Date, DateTime, ForeignKey, Index)
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import sessionmaker, relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.exc import IntegrityError
-from datetime import datetime
+from datetime import date, datetime
+from itertools import islice
 import logging
+import threading
+import time
+from config import get_database_config
+from metrics import observe_db_write
 
-# Database setup
-DATABASE_URL = "sqlite:///media_database.db"
-engine = create_engine(DATABASE_URL, echo=True)
-Session = sessionmaker(bind=engine)
+# Database setup; the engine and schema are created on first use, not at import
+DEFAULT_DATABASE_URL = "sqlite:///media_database.db"
 Base = declarative_base()
+_engine = None
+_engine_lock = threading.Lock()
+_session_factory = sessionmaker()
+
+# WAL lets readers (the GUI, streamed item queries) run alongside the pipeline's writes
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+def get_engine():
+    """Return the shared engine, creating it and bringing the schema up to date the first time it's needed."""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                database_config = get_database_config()
+                engine = create_engine(database_config.get('url', DEFAULT_DATABASE_URL), echo=database_config.get('echo', False))
+                if engine.dialect.name == 'sqlite':
+                    event.listen(engine, "connect", _set_sqlite_pragmas)
+                # Create tables
+                Base.metadata.create_all(engine)
+                _migrate_columns(engine)
+                _migrate_indexes(engine)
+                _session_factory.configure(bind=engine)
+                _engine = engine
+    return _engine
+
+def Session():
+    """Open an ORM session on the shared engine."""
+    get_engine()
+    return _session_factory()
 
 # Define MediaItem model
 class MediaItem(Base):
@@ -19,6 +57,8 @@ class MediaItem(Base):
     title = Column(String, nullable=False)
     media_type = Column(String, nullable=False)
     jellyfin_id = Column(String, unique=True, nullable=False)
+    tmdb_id = Column(Integer, nullable=True)
+    community_rating = Column(Float, nullable=True)
     added_date = Column(DateTime, default=datetime.utcnow)
 
 # Define Recommendation model
@@ -30,26 +70,237 @@ class Recommendation(Base):
     recommended_title = Column(String, nullable=False)
     recommended_type = Column(String, nullable=True)
     tmdb_id = Column(Integer, nullable=True)
+    rank = Column(Integer, nullable=True)  # Position in TMDB's recommendation list, 0 = first
+    release_date = Column(Date, nullable=True)  # Release date for movies, first air date for TV
+    popularity = Column(Float, nullable=True)
+    age_rating = Column(String, nullable=True)  # Certification such as 'PG-13' or 'TV-MA'
     created_at = Column(DateTime, default=datetime.utcnow)
+    notified_at = Column(DateTime, nullable=True)
     media_item = relationship("MediaItem", back_populates="recommendations")
 
+    __table_args__ = (
+        Index('uq_recommendations_item_title', 'media_item_id', 'recommended_title', unique=True),
+        Index('ix_recommendations_notified_at_id', 'notified_at', 'id'),
+    )
+
 MediaItem.recommendations = relationship("Recommendation", back_populates="media_item")
 
-# Create tables
-Base.metadata.create_all(engine)
+# Define SyncState model (per-folder high-water mark for incremental Jellyfin sync)
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+
+    id = Column(Integer, primary_key=True)
+    folder_id = Column(String, unique=True, nullable=False)
+    last_saved = Column(DateTime, nullable=True)
+    last_full_sync = Column(DateTime, nullable=True)
+
+# Define RecommendationScore model (one aggregated, weighted score per recommended title)
+class RecommendationScore(Base):
+    __tablename__ = 'recommendation_scores'
+
+    id = Column(Integer, primary_key=True)
+    recommended_title = Column(String, unique=True, nullable=False)
+    recommended_type = Column(String, nullable=True)
+    occurrences = Column(Integer, nullable=False, default=0)
+    score = Column(Float, nullable=False, default=0.0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_recommendation_scores_score', 'score'),
+    )
+
+# Define ScoringState model (id of the last recommendation folded into the scores)
+class ScoringState(Base):
+    __tablename__ = 'scoring_state'
+
+    id = Column(Integer, primary_key=True)
+    last_recommendation_id = Column(Integer, nullable=False, default=0)
+
+# Define RecommendationRefresh model (when every item's recommendations were last fetched again)
+class RecommendationRefresh(Base):
+    __tablename__ = 'recommendation_refresh'
+
+    id = Column(Integer, primary_key=True)
+    refreshed_at = Column(DateTime, nullable=False)
+
+# Define DigestBacklog model (a recipient group whose digest failed, and the last recommendation it did receive)
+class DigestBacklog(Base):
+    __tablename__ = 'digest_backlog'
+
+    id = Column(Integer, primary_key=True)
+    group_name = Column(String, unique=True, nullable=False)
+    after_id = Column(Integer, nullable=False)
+
+# Add columns introduced after a database was first created; create_all only creates missing tables
+def _migrate_columns(engine):
+    added = set()
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=engine.dialect)
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                logging.info(f"Added column {table.name}.{column.name}")
+                added.add((table.name, column.name))
+
+    # Recommendations stored before notification tracking existed were already emailed in full every run
+    if ('recommendations', 'notified_at') in added:
+        with engine.begin() as conn:
+            conn.execute(text("UPDATE recommendations SET notified_at = COALESCE(created_at, CURRENT_TIMESTAMP)"))
+
+# Create indexes added after a table was first created, dropping rows that would violate new unique ones
+def _migrate_indexes(engine):
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            if index.unique:
+                columns = ", ".join(column.name for column in index.columns)
+                with engine.begin() as conn:
+                    removed = conn.execute(text(
+                        f"DELETE FROM {table.name} WHERE id NOT IN (SELECT MIN(id) FROM {table.name} GROUP BY {columns})"
+                    )).rowcount
+                logging.info(f"Removed {removed} duplicate rows from {table.name} before indexing ({columns})")
+            index.create(engine)
+            logging.info(f"Created index {index.name}")
+
+# Rows written per transaction by the bulk APIs
+BULK_CHUNK_SIZE = 500
+
+def _chunks(iterable, size=BULK_CHUNK_SIZE):
+    """Yield lists of up to `size` elements without materialising the whole iterable."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _insert(table):
+    """Return a dialect-specific INSERT that supports ON CONFLICT clauses."""
+    dialect = postgresql if get_engine().dialect.name == 'postgresql' else sqlite
+    return dialect.insert(table)
+
+# Function to insert or update many media items, keyed on their Jellyfin id
+def upsert_media_items(items, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Insert or update media items in chunked transactions, keyed on the unique Jellyfin id.
+    Args:
+        items (iterable): Dicts with 'title', 'type', 'jellyfin_id' and optional 'tmdb_id', as yielded by JellyfinFetcher.
+        chunk_size (int): Rows written per transaction.
+    Returns:
+        dict: Counts of 'inserted', 'updated' and 'skipped' (missing required fields) items.
+    """
+    counts = {'inserted': 0, 'updated': 0, 'skipped': 0}
+    table = MediaItem.__table__
+    for chunk in _chunks(items, chunk_size):
+        rows = {}
+        for item in chunk:
+            if not item.get('title') or not item.get('jellyfin_id'):
+                counts['skipped'] += 1
+                continue
+            rows[item['jellyfin_id']] = {
+                'title': item['title'],
+                'media_type': item.get('type') or 'unknown',
+                'jellyfin_id': item['jellyfin_id'],
+                'tmdb_id': item.get('tmdb_id'),
+                'community_rating': item.get('community_rating'),
+                'added_date': datetime.utcnow()
+            }
+        if not rows:
+            continue
+
+        statement = _insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.jellyfin_id],
+            set_={
+                'title': statement.excluded.title,
+                'media_type': statement.excluded.media_type,
+                # Never drop a TMDB id that was resolved earlier
+                'tmdb_id': func.coalesce(statement.excluded.tmdb_id, table.c.tmdb_id),
+                'community_rating': func.coalesce(statement.excluded.community_rating, table.c.community_rating)
+            }
+        )
+        started = time.perf_counter()
+        with get_engine().begin() as conn:
+            existing = conn.execute(
+                select(func.count()).select_from(table).where(table.c.jellyfin_id.in_(list(rows)))
+            ).scalar()
+            conn.execute(statement, list(rows.values()))
+        observe_db_write('media_items', len(rows), time.perf_counter() - started)
+        counts['inserted'] += len(rows) - existing
+        counts['updated'] += existing
+    logging.info(f"Upserted media items: {counts['inserted']} inserted, {counts['updated']} updated, {counts['skipped']} skipped.")
+    return counts
+
+def _parse_date(value):
+    """A date from TMDB's 'YYYY-MM-DD' strings; empty or malformed values become None."""
+    if not value or isinstance(value, date):
+        return value or None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        return None
+
+# Function to add many recommendations, ignoring ones already stored for the same media item
+def add_recommendations(recommendations, chunk_size=BULK_CHUNK_SIZE):
+    """
+    Insert recommendations in chunked transactions, skipping (media item, title) pairs that already exist.
+    Args:
+        recommendations (iterable): Dicts with 'media_item_id', 'recommended_title' and optional
+            'recommended_type', 'tmdb_id', 'rank', 'release_date' (ISO string or date), 'popularity' and 'age_rating'.
+        chunk_size (int): Rows written per transaction.
+    Returns:
+        dict: Counts of 'inserted' and 'skipped' recommendations.
+    """
+    counts = {'inserted': 0, 'skipped': 0}
+    table = Recommendation.__table__
+    for chunk in _chunks(recommendations, chunk_size):
+        rows = [{
+            'media_item_id': rec['media_item_id'],
+            'recommended_title': rec['recommended_title'],
+            'recommended_type': rec.get('recommended_type'),
+            'tmdb_id': rec.get('tmdb_id'),
+            'rank': rec.get('rank'),
+            'release_date': _parse_date(rec.get('release_date')),
+            'popularity': rec.get('popularity'),
+            'age_rating': rec.get('age_rating'),
+            'created_at': datetime.utcnow()
+        } for rec in chunk if rec.get('recommended_title')]
+        counts['skipped'] += len(chunk) - len(rows)
+        if not rows:
+            continue
+
+        statement = _insert(table).on_conflict_do_nothing(index_elements=[table.c.media_item_id, table.c.recommended_title])
+        started = time.perf_counter()
+        with get_engine().begin() as conn:
+            inserted = conn.execute(statement, rows).rowcount
+        observe_db_write('recommendations', inserted, time.perf_counter() - started)
+        counts['inserted'] += inserted
+        counts['skipped'] += len(rows) - inserted
+    logging.info(f"Stored recommendations: {counts['inserted']} inserted, {counts['skipped']} skipped.")
+    return counts
 
 # Function to add a media item with duplicate handling
-def add_media_item(title, media_type, jellyfin_id, added_date=datetime.utcnow()):
+def add_media_item(title, media_type, jellyfin_id, added_date=datetime.utcnow(), tmdb_id=None):
     session = Session()
     try:
         # Check for duplicate based on title
         existing_item = session.query(MediaItem).filter_by(title=title).first()
         if existing_item:
+            # Backfill the TMDB id of items stored before Jellyfin provider ids were requested
+            if tmdb_id and not existing_item.tmdb_id:
+                existing_item.tmdb_id = tmdb_id
+                session.commit()
             logging.info(f"Skipping duplicate entry: {title}")
             return
         
         # Create new media item
-        media_item = MediaItem(title=title, media_type=media_type, jellyfin_id=jellyfin_id, added_date=added_date)
+        media_item = MediaItem(title=title, media_type=media_type, jellyfin_id=jellyfin_id, added_date=added_date, tmdb_id=tmdb_id)
         session.add(media_item)
         session.commit()
         logging.info(f"Inserted item: {title}")
@@ -82,11 +333,304 @@ def get_all_media_items():
     session = Session()
     items = session.query(MediaItem).all()
     session.close()
-    return [{'id': item.id, 'title': item.title, 'type': item.media_type} for item in items]
+    return [{'id': item.id, 'title': item.title, 'type': item.media_type, 'tmdb_id': item.tmdb_id} for item in items]
+
+# Function to stream media items in id order without loading the whole table
+def iter_media_items(chunk_size=BULK_CHUNK_SIZE, without_recommendations=False, added_since=None, shard=None):
+    """
+    Yield media items as lightweight dicts, reading `chunk_size` rows per query.
+    Each chunk is a short keyset-paginated query (id > last id seen), so memory stays flat and no read
+    transaction is held open while the caller writes between chunks.
+    Args:
+        chunk_size (int): Rows read per query.
+        without_recommendations (bool): Only yield items that have no stored recommendations yet.
+        added_since (datetime): Only yield items added at or after this time.
+        shard (tuple): (index, count) to only yield the items whose id modulo `count` is `index`.
+    """
+    table = MediaItem.__table__
+    query = select(table.c.id, table.c.title, table.c.media_type, table.c.tmdb_id)
+    if without_recommendations:
+        query = query.where(~exists().where(Recommendation.__table__.c.media_item_id == table.c.id))
+    if added_since:
+        query = query.where(table.c.added_date >= added_since)
+    if shard:
+        index, count = shard
+        query = query.where(table.c.id % count == index)
 
-# Function to get all recommendations
+    last_id = 0
+    while True:
+        with get_engine().connect() as conn:
+            rows = conn.execute(query.where(table.c.id > last_id).order_by(table.c.id).limit(chunk_size)).all()
+        if not rows:
+            return
+        for row in rows:
+            yield {'id': row.id, 'title': row.title, 'type': row.media_type, 'tmdb_id': row.tmdb_id}
+        last_id = rows[-1].id
+
+# Function to look up a single media item by its Jellyfin id
+def get_media_item_by_jellyfin_id(jellyfin_id):
+    session = Session()
+    item = session.query(MediaItem).filter_by(jellyfin_id=jellyfin_id).first()
+    session.close()
+    if not item:
+        return None
+    return {'id': item.id, 'title': item.title, 'type': item.media_type, 'tmdb_id': item.tmdb_id}
+
+# Function to look up many media items by Jellyfin id in one query
+def get_media_items_by_jellyfin_ids(jellyfin_ids, without_recommendations=False):
+    table = MediaItem.__table__
+    query = select(table.c.id, table.c.title, table.c.media_type, table.c.tmdb_id).where(table.c.jellyfin_id.in_(list(jellyfin_ids)))
+    if without_recommendations:
+        query = query.where(~exists().where(Recommendation.__table__.c.media_item_id == table.c.id))
+    with get_engine().connect() as conn:
+        rows = conn.execute(query.order_by(table.c.id)).all()
+    return [{'id': row.id, 'title': row.title, 'type': row.media_type, 'tmdb_id': row.tmdb_id} for row in rows]
+
+# Function to save a TMDB id resolved by title search so later runs can skip the search
+def set_media_item_tmdb_id(media_item_id, tmdb_id):
+    session = Session()
+    try:
+        session.query(MediaItem).filter_by(id=media_item_id).update({'tmdb_id': tmdb_id})
+        session.commit()
+    finally:
+        session.close()
+
+# Function to get recommendations that haven't been included in a notification yet, with their title's score
 def get_new_recommendations():
+    return _digest_rows(Recommendation.notified_at.is_(None))
+
+# Function to get the recommendations with ids in (after_id, last_id], notified or not, with their title's score
+def get_recommendations_between(after_id, last_id):
+    return _digest_rows(Recommendation.id > after_id, Recommendation.id <= last_id)
+
+# Recommendation rows for a digest, oldest first
+def _digest_rows(*criteria):
+    session = Session()
+    recommendations = (session.query(Recommendation.id, Recommendation.recommended_title, Recommendation.recommended_type,
+                                     Recommendation.release_date, Recommendation.age_rating,
+                                     RecommendationScore.score, RecommendationScore.occurrences)
+                       .outerjoin(RecommendationScore, RecommendationScore.recommended_title == Recommendation.recommended_title)
+                       .filter(*criteria)
+                       .order_by(Recommendation.id)
+                       .all())
+    session.close()
+    return [{'id': rec.id, 'recommended_title': rec.recommended_title, 'recommended_type': rec.recommended_type,
+             'release_date': rec.release_date, 'age_rating': rec.age_rating,
+             'score': rec.score or 0.0, 'occurrences': rec.occurrences or 0} for rec in recommendations]
+
+# Function to mark every unsent recommendation up to and including `last_id` as notified
+def mark_recommendations_notified(last_id):
+    session = Session()
+    try:
+        marked = (session.query(Recommendation)
+                  .filter(Recommendation.notified_at.is_(None), Recommendation.id <= last_id)
+                  .update({'notified_at': datetime.utcnow()}, synchronize_session=False))
+        session.commit()
+        logging.info(f"Marked {marked} recommendations as notified.")
+        return marked
+    finally:
+        session.close()
+
+# Function to stream unsent recommendations as (id, title, type, TMDB id), for checks that run in Python
+def iter_unnotified_recommendations(chunk_size=BULK_CHUNK_SIZE):
+    table = Recommendation.__table__
+    query = (select(table.c.id, table.c.recommended_title, table.c.recommended_type, table.c.tmdb_id)
+             .where(table.c.notified_at.is_(None)))
+    last_id = 0
+    while True:
+        with get_engine().connect() as conn:
+            rows = conn.execute(query.where(table.c.id > last_id).order_by(table.c.id).limit(chunk_size)).all()
+        if not rows:
+            return
+        for row in rows:
+            yield {'id': row.id, 'recommended_title': row.recommended_title, 'recommended_type': row.recommended_type,
+                   'tmdb_id': row.tmdb_id}
+        last_id = rows[-1].id
+
+# Function to delete recommendations by id, rebuilding the scores if any of them had already been counted
+def delete_recommendations(ids):
+    ids = sorted(ids)
+    if not ids:
+        return 0
+    session = Session()
+    try:
+        # Delete in chunks to stay under SQLite's bound-parameter limit
+        for start in range(0, len(ids), 500):
+            session.query(Recommendation).filter(Recommendation.id.in_(ids[start:start + 500])).delete(synchronize_session=False)
+        scored_up_to = session.query(ScoringState.last_recommendation_id).filter(ScoringState.id == 1).scalar() or 0
+        session.commit()
+    finally:
+        session.close()
+    if ids[0] <= scored_up_to:
+        rebuild_recommendation_scores()
+    return len(ids)
+
+# Function to get the recipient groups still owed a digest, with the last recommendation id each did receive
+def get_digest_backlog():
     session = Session()
-    recommendations = session.query(Recommendation).all()
+    backlog = session.query(DigestBacklog).all()
     session.close()
-    return [{'recommended_title': rec.recommended_title, 'recommended_type': rec.recommended_type} for rec in recommendations]
+    return {entry.group_name: entry.after_id for entry in backlog}
+
+# Function to record which groups' digests failed; every other group is caught up
+def update_digest_backlog(failed_groups, after_id):
+    session = Session()
+    try:
+        entries = {entry.group_name: entry for entry in session.query(DigestBacklog)}
+        for group, entry in entries.items():
+            if group not in failed_groups:
+                session.delete(entry)
+        for group in failed_groups:
+            # A group that was already behind keeps its older starting point
+            if group not in entries:
+                session.add(DigestBacklog(group_name=group, after_id=after_id))
+        session.commit()
+    finally:
+        session.close()
+
+# Function to get the sync state of every folder, keyed by folder id
+def get_sync_states():
+    session = Session()
+    states = session.query(SyncState).all()
+    session.close()
+    return {state.folder_id: {'last_saved': state.last_saved, 'last_full_sync': state.last_full_sync} for state in states}
+
+# Function to persist a folder's high-water mark after its items have been stored
+def update_sync_state(folder_id, last_saved=None, full_sync=False):
+    session = Session()
+    try:
+        state = session.query(SyncState).filter_by(folder_id=folder_id).first()
+        if not state:
+            state = SyncState(folder_id=folder_id)
+            session.add(state)
+        if last_saved and (not state.last_saved or last_saved > state.last_saved):
+            state.last_saved = last_saved
+        if full_sync:
+            state.last_full_sync = datetime.utcnow()
+        session.commit()
+    finally:
+        session.close()
+
+# Function to get when recommendations were last refreshed for every item, or None if they never were
+def get_last_recommendation_refresh():
+    session = Session()
+    state = session.query(RecommendationRefresh).first()
+    session.close()
+    return state.refreshed_at if state else None
+
+# Function to record that recommendations were just refreshed for every item
+def mark_recommendation_refresh():
+    session = Session()
+    try:
+        state = session.query(RecommendationRefresh).first()
+        if not state:
+            state = RecommendationRefresh()
+            session.add(state)
+        state.refreshed_at = datetime.utcnow()
+        session.commit()
+    finally:
+        session.close()
+
+# Function to remove media items (and their recommendations) no longer present in Jellyfin
+def remove_missing_media_items(seen_jellyfin_ids):
+    session = Session()
+    try:
+        stale_ids = [item_id for item_id, jellyfin_id in session.query(MediaItem.id, MediaItem.jellyfin_id)
+                     if jellyfin_id not in seen_jellyfin_ids]
+        # Delete in chunks to stay under SQLite's bound-parameter limit
+        for start in range(0, len(stale_ids), 500):
+            chunk = stale_ids[start:start + 500]
+            session.query(Recommendation).filter(Recommendation.media_item_id.in_(chunk)).delete(synchronize_session=False)
+            session.query(MediaItem).filter(MediaItem.id.in_(chunk)).delete(synchronize_session=False)
+        session.commit()
+        logging.info(f"Removed {len(stale_ids)} media items no longer in Jellyfin.")
+    finally:
+        session.close()
+    if stale_ids:
+        # Removed rows can't be subtracted from the running totals cheaply; removals are rare (full syncs only)
+        rebuild_recommendation_scores()
+    return len(stale_ids)
+
+# Recommendation scoring: each (library item, recommended title) row adds rank weight * source rating weight
+# to its title's score. TMDB lists 20 recommendations per page; the first scores 1.0, the 20th 0.05.
+RANK_SLOTS = 20
+MIN_RANK_WEIGHT = 0.05
+DEFAULT_RANK_WEIGHT = 0.5  # Rows stored before ranks were recorded
+DEFAULT_SOURCE_RATING = 6.5  # Jellyfin CommunityRating (0-10) assumed for unrated library items
+SCORE_BATCH_SIZE = 50000
+
+def _recommendation_weight():
+    """SQL expression for the weight one recommendation row contributes to its title's score."""
+    recommendations = Recommendation.__table__
+    media_items = MediaItem.__table__
+    rank_weight = case(
+        (recommendations.c.rank.is_(None), DEFAULT_RANK_WEIGHT),
+        (recommendations.c.rank >= RANK_SLOTS, MIN_RANK_WEIGHT),
+        else_=(RANK_SLOTS - recommendations.c.rank) / float(RANK_SLOTS)
+    )
+    rating_weight = func.coalesce(media_items.c.community_rating, DEFAULT_SOURCE_RATING) / 10.0
+    return rank_weight * rating_weight
+
+# Function to fold recommendations stored since the last call into the per-title scores
+def update_recommendation_scores(batch_size=SCORE_BATCH_SIZE):
+    """
+    Incrementally update recommendation_scores from rows added since the last update.
+    Each batch is a single INSERT ... SELECT ... GROUP BY upsert, so the database does the counting and weighting
+    and only new rows are read. Returns the number of recommendation rows scored.
+    """
+    recommendations = Recommendation.__table__
+    media_items = MediaItem.__table__
+    scores = RecommendationScore.__table__
+    state = ScoringState.__table__
+    scored = 0
+    while True:
+        started = time.perf_counter()
+        with get_engine().begin() as conn:
+            last_id = conn.execute(select(state.c.last_recommendation_id).where(state.c.id == 1)).scalar()
+            if last_id is None:
+                conn.execute(state.insert().values(id=1, last_recommendation_id=0))
+                last_id = 0
+            # Upper id of the next batch: the batch_size-th id past the watermark, or the newest id
+            newer = select(recommendations.c.id).where(recommendations.c.id > last_id)
+            end_id = conn.execute(newer.order_by(recommendations.c.id).offset(batch_size - 1).limit(1)).scalar()
+            if end_id is None:
+                end_id = conn.execute(select(func.max(recommendations.c.id)).where(recommendations.c.id > last_id)).scalar()
+                if end_id is None:
+                    break
+
+            aggregated = (
+                select(recommendations.c.recommended_title, func.max(recommendations.c.recommended_type),
+                       func.count(), func.sum(_recommendation_weight()), literal(datetime.utcnow()))
+                .select_from(recommendations.outerjoin(media_items, media_items.c.id == recommendations.c.media_item_id))
+                .where(recommendations.c.id > last_id, recommendations.c.id <= end_id)
+                .group_by(recommendations.c.recommended_title)
+            )
+            statement = _insert(scores).from_select(
+                ['recommended_title', 'recommended_type', 'occurrences', 'score', 'updated_at'], aggregated
+            )
+            statement = statement.on_conflict_do_update(
+                index_elements=[scores.c.recommended_title],
+                set_={
+                    'recommended_type': func.coalesce(statement.excluded.recommended_type, scores.c.recommended_type),
+                    'occurrences': scores.c.occurrences + statement.excluded.occurrences,
+                    'score': scores.c.score + statement.excluded.score,
+                    'updated_at': statement.excluded.updated_at
+                }
+            )
+            conn.execute(statement)
+            batch = conn.execute(
+                select(func.count()).where(recommendations.c.id > last_id, recommendations.c.id <= end_id)
+            ).scalar()
+            conn.execute(state.update().where(state.c.id == 1).values(last_recommendation_id=end_id))
+        scored += batch
+        observe_db_write('recommendation_scores', batch, time.perf_counter() - started)
+    if scored:
+        logging.info(f"Scored {scored} new recommendations.")
+    return scored
+
+# Function to recompute every score from scratch
+def rebuild_recommendation_scores():
+    with get_engine().begin() as conn:
+        conn.execute(RecommendationScore.__table__.delete())
+        conn.execute(ScoringState.__table__.delete())
+    return update_recommendation_scores()
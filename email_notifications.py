@@ -1,65 +1,180 @@
-import smtplib
+import gzip
 import json
 import logging
+import time
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.application import MIMEApplication
 
-from utils import log_error, get_email_smtp_client
+from mailer import SMTPMailer
+from utils import log_error
 from config import get_email_config  # Import email configuration retrieval function
 
 logging.basicConfig(level=logging.INFO)
 
-def send_summary_notification(recommendations):
-    """Send a summary notification email with a list of new recommendations."""
+# Oldest audience a certification is suitable for; unknown certifications are treated as unrated
+CERTIFICATION_AGES = {
+    'G': 0, 'U': 0, 'TV-Y': 0, 'TV-G': 0, 'TV-Y7': 7, 'PG': 10, 'TV-PG': 10, '12A': 12,
+    'PG-13': 13, 'TV-14': 14, 'R': 17, 'TV-MA': 17, 'NC-17': 18
+}
+# Highest certification age each recipient group receives; groups not listed receive everything
+GROUP_MAX_AGES = {'all_ages': 10, 'teen': 15, 'adult': None}
+
+# Large-digest defaults: titles listed in the body, attachment size worth compressing, and relay size limit
+DIGEST_TOP_N = 20
+GZIP_THRESHOLD_BYTES = 64 * 1024
+MAX_MESSAGE_BYTES = 5 * 1024 * 1024
+
+def rating_age(rating):
+    """Return the minimum viewer age for a certification such as 'PG-13', 'TV-MA' or '15', or None if unknown."""
+    if not rating:
+        return None
+    rating = str(rating).strip().upper()
+    if rating in CERTIFICATION_AGES:
+        return CERTIFICATION_AGES[rating]
+    digits = ''.join(ch for ch in rating if ch.isdigit())
+    return int(digits) if digits else None
+
+def recommendations_for_group(recommendations, group, unrated_groups=('adult',)):
+    """Filter recommendations down to the ones whose age rating suits a recipient group."""
+    max_age = GROUP_MAX_AGES.get(group)
+    selected = []
+    for rec in recommendations:
+        age = rating_age(rec.get('age_rating'))
+        if age is None:
+            if group in unrated_groups:
+                selected.append(rec)
+        elif max_age is None or age <= max_age:
+            selected.append(rec)
+    return selected
+
+def rank_recommendations(recommendations):
+    """Collapse recommendations to one entry per title, highest aggregated score first."""
+    ranked = {}
+    for rec in recommendations:
+        ranked.setdefault(rec['recommended_title'], rec)
+    return sorted(ranked.values(), key=lambda rec: (-(rec.get('score') or 0), rec['recommended_title']))
+
+def _render_attachment(recommendations, gzip_threshold):
+    """Serialise recommendations as compact JSON, gzipped once it grows past `gzip_threshold` bytes."""
+    payload = json.dumps(recommendations, separators=(",", ":"), default=str).encode("utf-8")
+    if len(payload) > gzip_threshold:
+        attachment = MIMEApplication(gzip.compress(payload), "gzip")
+        attachment.add_header("Content-Disposition", "attachment", filename="recommendations_summary.json.gz")
+    else:
+        attachment = MIMEApplication(payload, "json")
+        attachment.add_header("Content-Disposition", "attachment", filename="recommendations_summary.json")
+    return attachment
+
+def _render_message(recommendations, sender, recipients, top_n, gzip_threshold, part=1, parts=1, total=None):
+    """Render one digest message: a top-N summary in the body and, if the list is longer, the rest attached."""
+    total = total if total is not None else len(recommendations)
+
+    # Compose the email content in one pass
+    shown = recommendations[:top_n] if part == 1 else []
+    lines = ["Here are your new recommendations:\n"] if part == 1 else [f"Recommendation list, part {part} of {parts}.\n"]
+    lines.extend(
+        f"{position}. {rec['recommended_title']} (Type: {rec['recommended_type']}) - "
+        f"recommended by {rec.get('occurrences') or 1} of your titles, score {rec.get('score') or 0:.2f}"
+        for position, rec in enumerate(shown, 1)
+    )
+    attach = parts > 1 or len(recommendations) > top_n
+    if attach:
+        lines.append(f"\nThe full list of {len(recommendations)} recommendations in this email is attached.")
+    email_content = MIMEText("\n".join(lines) + "\n", "plain")
+
+    # Prepare the email
+    subject = f"New Recommendations - {total} New Items"
+    if parts > 1:
+        subject += f" (part {part}/{parts})"
+
+    # Creating the email structure
+    message = MIMEMultipart()
+    message["From"] = sender
+    message["To"] = ", ".join(recipients)
+    message["Subject"] = subject
+    message.attach(email_content)
+    if attach:
+        message.attach(_render_attachment(recommendations, gzip_threshold))
+    return message
+
+def build_digests(recommendations, sender, recipients, top_n=DIGEST_TOP_N, gzip_threshold=GZIP_THRESHOLD_BYTES,
+                  max_message_bytes=MAX_MESSAGE_BYTES):
+    """
+    Build the digest for one recipient group, split into "part i/N" messages if it would exceed `max_message_bytes`.
+    Returns a list of (message, size in bytes) tuples.
+    """
+    started = time.perf_counter()
+    parts = 1
+    while True:
+        size = -(-len(recommendations) // parts)  # Ceiling division
+        messages = []
+        for part in range(parts):
+            message = _render_message(recommendations[part * size:(part + 1) * size], sender, recipients, top_n,
+                                      gzip_threshold, part=part + 1, parts=parts, total=len(recommendations))
+            messages.append((message, len(message.as_bytes())))
+        largest = max(message_size for _, message_size in messages)
+        # Stop once every part fits, or when parts can't get any smaller
+        if largest <= max_message_bytes or size <= 1:
+            break
+        parts = max(parts + 1, -(-parts * largest // max_message_bytes))
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logging.info(f"Rendered {len(messages)} digest message(s) for {len(recommendations)} recommendations in "
+                 f"{elapsed_ms:.1f} ms ({sum(message_size for _, message_size in messages)} bytes, largest {largest}).")
+    return messages
+
+def send_summary_notification(recommendations, backlog=None):
+    """
+    Send each recipient group a ranked digest of the new recommendations suited to its age rating.
+    `backlog` maps a group that missed earlier digests to its own, longer list of rows to send instead.
+    All digests share one small pool of SMTP connections. Returns {group: True if all of its digest was sent}
+    for every group that had something to send, None below the notification threshold, or False on an error.
+    """
+    backlog = backlog or {}
     try:
         # Retrieve email configuration
         email_config = get_email_config()
         sender = email_config["sender"]
-        smtp_server = email_config["smtp_server"]
-        smtp_port = email_config["smtp_port"]
         recipient_groups = email_config["recipient_groups"]
-        password = email_config["password"]
         threshold = email_config.get("notification_threshold", 5)  # Default threshold if not set
+        unrated_groups = email_config.get("unrated_groups", ['adult'])
 
         if len(recommendations) < threshold:
             logging.info(f"New recommendations ({len(recommendations)}) do not exceed the threshold ({threshold}).")
-            return  # Do not send email if recommendations are below the threshold
-
-        # Compose the email content
-        summary_content = "Here are your new recommendations:\n\n"
-        for rec in recommendations:
-            summary_content += f"Title: {rec['recommended_title']} (Type: {rec['recommended_type']})\n"
-        
-        email_content = MIMEText(summary_content, "plain")
-
-        # Prepare the email
-        subject = f"New Recommendations - {len(recommendations)} New Items"
-        recipients = [email for group in recipient_groups.values() for email in group]
-
-        # Creating the email structure
-        message = MIMEMultipart()
-        message["From"] = sender
-        message["To"] = ", ".join(recipients)
-        message["Subject"] = subject
-        message.attach(email_content)
-
-        # Attach JSON file if recommendations are extensive
-        if len(recommendations) > 20:
-            attachment = MIMEApplication(json.dumps(recommendations, indent=2).encode("utf-8"))
-            attachment.add_header("Content-Disposition", "attachment", filename="recommendations_summary.json")
-            message.attach(attachment)
-
-        # Send the email
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(sender, password)
-            server.sendmail(sender, recipients, message.as_string())
-        
-        logging.info(f"Summary email sent with {len(recommendations)} recommendations.")
+            return None  # Do not send email if recommendations are below the threshold
+
+        # One line per title, best first; the same title recommended by several library items is listed once
+        ranked = rank_recommendations(recommendations)
+        envelopes, envelope_groups = [], []
+        for group, recipients in recipient_groups.items():
+            group_ranked = rank_recommendations(backlog[group]) if group in backlog else ranked
+            group_recommendations = recommendations_for_group(group_ranked, group, unrated_groups)
+            if not recipients or not group_recommendations:
+                logging.info(f"No recommendations to send to group '{group}'.")
+                continue
+            messages = build_digests(
+                group_recommendations, sender, recipients,
+                top_n=int(email_config.get("digest_top_n", DIGEST_TOP_N)),
+                gzip_threshold=int(email_config.get("gzip_threshold_bytes", GZIP_THRESHOLD_BYTES)),
+                max_message_bytes=int(email_config.get("max_message_bytes", MAX_MESSAGE_BYTES))
+            )
+            envelopes.extend((message, sender, recipients) for message, _ in messages)
+            envelope_groups.extend(group for _ in messages)
+
+        # Send the emails
+        with SMTPMailer(pool_size=int(email_config.get("smtp_pool_size", 2))) as mailer:
+            results = mailer.send_many(envelopes)
+
+        logging.info(f"Sent {sum(results)} of {len(envelopes)} digest messages for {len(recommendations)} recommendations.")
+        sent = {}
+        for group, result in zip(envelope_groups, results):
+            sent[group] = sent.get(group, True) and result
+        return sent
 
     except Exception as e:
         log_error(f"Error sending summary notification: {e}")
+        return False
 
 def get_new_recommendations():
     """Stub function to retrieve new recommendations. This should interact with the database."""
@@ -1,28 +1,71 @@
 import requests
 import logging
-from config import get_jellyfin_config, get_tmdb_config
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from config import get_jellyfin_config
+from utils import call_with_retry, CircuitOpenError
+from metrics import timed_get
 
 logging.basicConfig(level=logging.INFO)
 
+# Jellyfin writes .NET timestamps with 7 fractional digits; fromisoformat before Python 3.11 only takes 3 or 6
+_FRACTION = re.compile(r'\.(\d+)')
+
+def parse_jellyfin_date(value):
+    """Parse a Jellyfin timestamp such as '2024-05-03T12:34:56.1234567Z' into a naive UTC datetime."""
+    value = _FRACTION.sub(lambda match: '.' + match.group(1)[:6].ljust(6, '0'), value.replace('Z', '+00:00'), count=1)
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
 class JellyfinFetcher:
+    # Only ask Jellyfin for what we use; Name, Id and Type are always returned
+    ITEM_FIELDS = 'CommunityRating,DateLastSaved,ProviderIds'
+    # Item types whose Tmdb provider id can be used with TMDB's movie/tv endpoints (episode ids can't)
+    TMDB_ID_TYPES = ('Movie', 'Series')
+    # Jellyfin item types mapped to TMDB media types; other items fall back to their folder's CollectionType
+    ITEM_MEDIA_TYPES = {'Movie': 'movie', 'Series': 'tv'}
+    DEFAULT_PAGE_SIZE = 500
+    DEFAULT_MAX_WORKERS = 4
+    # (connect, read) seconds; a server that accepts the connection but never answers must still fail
+    DEFAULT_TIMEOUT = (5, 30)
+
     def __init__(self):
         jellyfin = get_jellyfin_config()
         self.api_key = jellyfin.get('api_key')
         self.server_url = jellyfin.get('url').rstrip('/')
+        self.page_size = int(jellyfin.get('page_size', self.DEFAULT_PAGE_SIZE))
+        self.max_workers = max(1, int(jellyfin.get('max_workers', self.DEFAULT_MAX_WORKERS)))
+        timeout = jellyfin.get('timeout', self.DEFAULT_TIMEOUT)
+        self.timeout = tuple(float(part) for part in timeout) if isinstance(timeout, (list, tuple)) else float(timeout)
         self.headers = {
             'X-Emby-Token': self.api_key,
             'Accept': 'application/json'
         }
+        # Shared keep-alive session, pooled so every worker thread can reuse a connection
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.host = urlparse(self.server_url).netloc
         # Store fetched media folders
         self.media_folders = []
+        # Highest DateLastSaved seen per folder, and folders whose fetch failed or came up short, during the last iteration
+        self.watermarks = {}
+        self.failed_folders = set()
+        self.folder_totals = {}  # folder id -> item count Jellyfin reported
 
     def fetch_media_folders(self):
         """Fetch all media items directly from /Library/MediaFolders."""
         endpoint = f"{self.server_url}/Library/MediaFolders"
         try:
-            response = requests.get(endpoint, headers=self.headers)
-            response.raise_for_status()
-            folders = response.json().get('Items', [])
+            folders = self._get_json(endpoint).get('Items', [])
             
             # Log and store folder details for movies and TV shows
             for folder in folders:
@@ -36,101 +79,176 @@ class JellyfinFetcher:
                     'type': folder.get('CollectionType')  # CollectionType could be "movies" or "tvshows"
                 })
         
-        except requests.RequestException as e:
+        except (requests.RequestException, CircuitOpenError) as e:
             logging.error(f"Error fetching media folders: {e}")
-            if e.response:
+            if getattr(e, 'response', None):
                 logging.debug(f"Response details: {e.response.text}")
 
-    def fetch_all_media(self):
-        """Fetch media items for each folder."""
-        all_media = []
-        
+    def iter_media(self, page_size=None, since=None):
+        """
+        Yield media items folder by folder, one page at a time, as they arrive from Jellyfin.
+        Args:
+            page_size (int): Number of items requested per page, defaults to the configured page size.
+            since (dict): Optional mapping of folder id to a datetime; only items saved after it are fetched.
+        """
+        page_size = page_size or self.page_size
+        since = since or {}
+        self.watermarks = {}
+        self.failed_folders = set()
+        self.folder_totals = {}
+
         # Ensure media folders are fetched
         if not self.media_folders:
             self.fetch_media_folders()
-        
-        for folder in self.media_folders:
-            folder_id = folder.get('id')
-            media_type = folder.get('type', 'unknown')
-            logging.info(f"Fetching items from folder '{folder['name']}' (ID: {folder_id}, Type: {media_type}).")
-            
-            # Here we use the MediaItems endpoint within each folder context
-            endpoint = f"{self.server_url}/Items"
-            params = {
-                'ParentId': folder_id,
-                'Recursive': 'true',
-                'Fields': 'Name,Id,CommunityRating,Type'
-            }
-            
-            try:
-                response = requests.get(endpoint, headers=self.headers, params=params)
-                response.raise_for_status()
-                items = response.json().get('Items', [])
-                
-                # Append fetched items to the overall media list with type for each folder
-                all_media.extend([{
+
+        if self.max_workers > 1:
+            pages = self._iter_pages_concurrent(page_size, since)
+        else:
+            pages = self._iter_pages_serial(page_size, since)
+
+        counts = {}
+        for folder, items in pages:
+            folder_type = 'movie' if folder.get('type') == 'movies' else 'tv'
+            for item in items:
+                self._update_watermark(folder['id'], item.get('DateLastSaved'))
+                yield {
                     'title': item['Name'],
                     'jellyfin_id': item['Id'],
-                    'type': 'movie' if media_type == 'movies' else 'tv'  # Map Jellyfin types to TMDB types
-                } for item in items])
-                
-                logging.info(f"Fetched {len(items)} items from folder '{folder['name']}'.")
-                
-            except requests.RequestException as e:
-                logging.error(f"Error fetching items from folder '{folder['name']}': {e}")
-                if e.response:
-                    logging.debug(f"Response details: {e.response.text}")
-        
-        logging.info(f"Total fetched media items: {len(all_media)}")
-        return all_media
+                    # The item's own type wins, so a movie in a mixed or collection folder isn't stored as TV
+                    'type': self.ITEM_MEDIA_TYPES.get(item.get('Type'), folder_type),
+                    'tmdb_id': self._tmdb_id(item),
+                    'community_rating': item.get('CommunityRating')
+                }
+            counts[folder['id']] = counts.get(folder['id'], 0) + len(items)
 
-class TMDBHelper:
-    def __init__(self):
-        tmdb = get_tmdb_config()
-        self.api_key = tmdb.get('api_key')
-        self.base_url = 'https://api.themoviedb.org/3'
-        if not self.api_key:
-            logging.error("TMDB API key missing in configuration.")
-            raise ValueError("TMDB configuration error")
-
-    def get_recommendations(self, title, media_type='movie'):
-        """Fetch recommendations from TMDB."""
-        try:
-            # Ensure the media_type is either 'movie' or 'tv' for TMDB endpoints
-            media_type = 'movie' if media_type == 'movie' else 'tv'
-            
-            # Set the endpoint dynamically based on media_type (movie or tv)
-            endpoint = f"{self.base_url}/search/{media_type}"
-            params = {'query': title, 'api_key': self.api_key}
-            response = requests.get(endpoint, params=params)
+        for folder in self.media_folders:
+            fetched, total = counts.get(folder['id'], 0), self.folder_totals.get(folder['id'])
+            logging.info(f"Fetched {fetched} items from folder '{folder['name']}'.")
+            # A walk that doesn't add up to the reported total may have skipped items; never reconcile removals from it
+            if total is not None and fetched != total and folder['id'] not in self.failed_folders:
+                logging.warning(f"Folder '{folder['name']}' reported {total} items but {fetched} were fetched; "
+                                f"treating it as incomplete.")
+                self.failed_folders.add(folder['id'])
+        logging.info(f"Total fetched media items: {sum(counts.values())}")
+
+    def _iter_pages_serial(self, page_size, since):
+        """Walk folders one after another, yielding (folder, items) for each page."""
+        for folder in self.media_folders:
+            logging.info(f"Fetching items from folder '{folder['name']}' (ID: {folder['id']}, Type: {folder.get('type')}).")
+            start_index = 0
+            while True:
+                page = self._fetch_page(folder, start_index, page_size, since.get(folder['id']), start_index == 0)
+                if page is None:
+                    break
+                items, _ = page
+                if items:
+                    yield folder, items
+                # A short page means we've reached the end of the folder
+                if len(items) < page_size:
+                    break
+                start_index += len(items)
+
+    def _iter_pages_concurrent(self, page_size, since):
+        """
+        Fetch folders, and pages within folders, on a bounded thread pool, yielding (folder, items) as pages complete.
+        The first page of each folder reports the folder's total so its remaining pages can be scheduled; at most
+        twice max_workers pages are in flight or buffered at once to keep memory flat.
+        """
+        backlog = deque((folder, 0, True) for folder in self.media_folders)
+        max_pending = self.max_workers * 2
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='jellyfin') as executor:
+            while backlog or pending:
+                while backlog and len(pending) < max_pending:
+                    folder, start_index, first = backlog.popleft()
+                    if start_index == 0:
+                        logging.info(f"Fetching items from folder '{folder['name']}' (ID: {folder['id']}, Type: {folder.get('type')}).")
+                    future = executor.submit(self._fetch_page, folder, start_index, page_size,
+                                             since.get(folder['id']), first)
+                    pending[future] = (folder, start_index, first)
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    folder, start_index, first = pending.pop(future)
+                    page = future.result()
+                    if page is None:
+                        continue
+                    items, total = page
+                    if first and total is not None:
+                        backlog.extend((folder, start_index, False) for start_index in range(len(items), total, page_size))
+                    elif first and len(items) == page_size:
+                        # No total reported; keep walking this folder one page at a time
+                        backlog.append((folder, start_index + len(items), True))
+                    if items:
+                        yield folder, items
+
+    def _get_json(self, endpoint, params=None):
+        """GET a Jellyfin endpoint, retrying transient failures behind the server's circuit breaker."""
+        def request():
+            # A timeout is retried and counts against the circuit breaker like any other transport failure
+            response = timed_get(self.session.get, endpoint, self.host, params=params, timeout=self.timeout)
             response.raise_for_status()
-            results = response.json().get('results', [])
-            if not results:
-                logging.warning(f"No TMDB results for '{title}'")
-                return []
-
-            # Use the first result's ID to fetch recommendations
-            tmdb_id = results[0].get('id')
-            return self._fetch_tmdb_recommendations(tmdb_id, media_type)
-        except requests.RequestException as e:
-            logging.error(f"TMDB API request error for '{title}': {e}")
-            return []
-
-    def _fetch_tmdb_recommendations(self, tmdb_id, media_type):
-        """Fetch recommendations by TMDB ID."""
+            return response.json()
+        return call_with_retry(request, host=self.host)
+
+    def _fetch_page(self, folder, start_index, page_size, min_date_last_saved=None, with_total=False):
+        """Fetch one page of a folder. Returns (items, total record count or None), or None on error."""
+        endpoint = f"{self.server_url}/Items"
+        params = {
+            'ParentId': folder.get('id'),
+            'Recursive': 'true',
+            'Fields': self.ITEM_FIELDS,
+            # A stable order keeps offsets meaning the same items between pages; items added mid-walk sort last
+            'SortBy': 'DateCreated,SortName',
+            'SortOrder': 'Ascending',
+            'StartIndex': start_index,
+            'Limit': page_size,
+            'EnableImages': 'false',
+            'EnableUserData': 'false',
+            'EnableTotalRecordCount': 'true' if with_total else 'false'
+        }
+        if min_date_last_saved:
+            params['MinDateLastSaved'] = min_date_last_saved.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
         try:
-            endpoint = f"{self.base_url}/{media_type}/{tmdb_id}/recommendations"
-            params = {'api_key': self.api_key}
-            response = requests.get(endpoint, params=params)
-            response.raise_for_status()
-            recommendations = response.json().get('results', [])
-            logging.info(f"Retrieved {len(recommendations)} recommendations for TMDB ID {tmdb_id}")
-            
-            # Safely access 'title' key and fallback to empty if missing
-            return [rec.get('title', 'Unknown Title') for rec in recommendations]
-        except requests.RequestException as e:
-            logging.error(f"Error fetching TMDB recommendations for ID {tmdb_id}: {e}")
-            return []
+            data = self._get_json(endpoint, params)
+            total = data.get('TotalRecordCount') if with_total else None
+            if total is not None:
+                self.folder_totals[folder.get('id')] = total
+            return data.get('Items', []), total
+        except (requests.RequestException, CircuitOpenError) as e:
+            logging.error(f"Error fetching items from folder '{folder['name']}' at offset {start_index}: {e}")
+            self.failed_folders.add(folder.get('id'))
+            if getattr(e, 'response', None):
+                logging.debug(f"Response details: {e.response.text}")
+            return None
+
+    def _tmdb_id(self, item):
+        """Return the TMDB id Jellyfin knows for a movie or series, or None."""
+        if item.get('Type') not in self.TMDB_ID_TYPES:
+            return None
+        provider_ids = {key.lower(): value for key, value in (item.get('ProviderIds') or {}).items()}
+        try:
+            return int(provider_ids['tmdb'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _update_watermark(self, folder_id, date_last_saved):
+        """Track the newest DateLastSaved seen in a folder as a naive UTC datetime."""
+        if not date_last_saved:
+            return
+        try:
+            saved = parse_jellyfin_date(date_last_saved)
+        except ValueError:
+            # The watermark can't advance past this item, so the next sync re-reads from the previous one
+            logging.warning(f"Unparseable DateLastSaved '{date_last_saved}' in folder {folder_id}")
+            return
+        if folder_id not in self.watermarks or saved > self.watermarks[folder_id]:
+            self.watermarks[folder_id] = saved
+
+    def fetch_all_media(self):
+        """Fetch media items for each folder."""
+        return list(self.iter_media())
 
 # Example usage
 if __name__ == "__main__":
@@ -138,8 +256,9 @@ if __name__ == "__main__":
     all_media = fetcher.fetch_all_media()
     logging.info(f"Fetched media items: {all_media}")
 
-    # Fetch recommendations for an example title
-    tmdb_helper = TMDBHelper()
-    for media in all_media:
-        recommendations = tmdb_helper.get_recommendations(media['title'], media['type'])
-        logging.info(f"Recommendations for '{media['title']}': {recommendations}")
+    # Fetch recommendations for the fetched items; TMDB lookups go through the shared client
+    from async_tmdb import AsyncTMDBClient
+    items = [dict(media, id=media['jellyfin_id']) for media in all_media]
+    recommendations = AsyncTMDBClient().get_recommendations_many(items)
+    for media in items:
+        logging.info(f"Recommendations for '{media['title']}': {[rec['title'] for rec in recommendations.get(media['id'], [])]}")
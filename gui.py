@@ -3,10 +3,293 @@ import sys
 from PyQt5 import QtWidgets, QtCore, QtGui
 from PyQt5.QtCore import QTimer
 import sqlite3
-from main import main
 
 
-DB_NAME = 'media_monitoring.db'
+def database_path():
+    """Path of the SQLite file the pipeline writes, taken from the 'database' config section."""
+    from config import get_database_config
+    url = get_database_config().get('url', "sqlite:///media_database.db")
+    return url.split(":///", 1)[1] if url.startswith("sqlite:///") else 'media_database.db'
+
+
+class RecommendationsModel(QtCore.QAbstractTableModel):
+    """
+    Read-only table model over the pipeline's recommendations table that loads rows lazily in chunks.
+    Sorting and filtering are pushed down to SQLite as ORDER BY / WHERE, and chunks are paged by keyset
+    (sort value, id) after the last loaded row rather than by OFFSET. refresh() first checks PRAGMA
+    data_version, so it costs nothing when no other connection has written; in id order it then only pulls
+    rows past its id cursor plus rows notified since the last check.
+    """
+    # Scores come from the pipeline's per-title aggregate, joined in by title
+    SOURCE = "recommendations r LEFT JOIN recommendation_scores s ON s.recommended_title = r.recommended_title"
+    # (header, SQL expression) per visible column
+    COLUMNS = [
+        ("Title", "r.recommended_title"),
+        ("Score", "s.score"),
+        ("Recommended By", "s.occurrences"),
+        ("Release Date", "r.release_date"),
+        ("Age Rating", "r.age_rating"),
+        ("Notified At", "r.notified_at")
+    ]
+    CHUNK_SIZE = 200
+
+    def __init__(self, db_path, parent=None):
+        super().__init__(parent)
+        self.db_path = db_path
+        self.conn = None
+        self.rows = []
+        self.positions = {}
+        self.total = 0
+        self.max_id = 0
+        self.last_notified = None
+        self.data_version = None
+        self.filter_text = ""
+        self.sort_column = None
+        self.sort_order = QtCore.Qt.AscendingOrder
+        # Nothing is queried until start(), so the window can show before the first load
+        self.started = False
+
+    def start(self):
+        """Load the first chunk; called once the window is on screen."""
+        self.started = True
+        self.reload()
+
+    def _connect(self):
+        """Open the long-lived read-only connection once the pipeline has created (and migrated) the database."""
+        if self.conn is None:
+            try:
+                self.conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+                expressions = ", ".join(expression for _, expression in self.COLUMNS)
+                self.conn.execute(f"SELECT {expressions} FROM {self.SOURCE} LIMIT 1")
+            except sqlite3.Error:
+                if self.conn:
+                    self.conn.close()
+                self.conn = None
+        return self.conn is not None
+
+    def _where(self, extra=None):
+        clauses, params = [], []
+        if self.filter_text:
+            clauses.append("r.recommended_title LIKE ?")
+            params.append(f"%{self.filter_text}%")
+        if extra:
+            clauses.append(extra[0])
+            params.extend(extra[1])
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def _order_by(self):
+        if self.sort_column is None:
+            return " ORDER BY r.id"
+        direction = "DESC" if self.sort_order == QtCore.Qt.DescendingOrder else "ASC"
+        return f" ORDER BY {self.COLUMNS[self.sort_column][1]} {direction}, r.id"
+
+    def _after(self, row):
+        """WHERE clause for the rows that come after `row` in the current sort order."""
+        if self.sort_column is None:
+            return "r.id > ?", [row[0]]
+        expression, value = self.COLUMNS[self.sort_column][1], row[self.sort_column + 1]
+        descending = self.sort_order == QtCore.Qt.DescendingOrder
+        # SQLite puts NULLs first when ascending and last when descending
+        if value is None:
+            if descending:
+                return f"({expression} IS NULL AND r.id > ?)", [row[0]]
+            return f"(({expression} IS NULL AND r.id > ?) OR {expression} IS NOT NULL)", [row[0]]
+        clause = f"{expression} {'<' if descending else '>'} ? OR ({expression} = ? AND r.id > ?)"
+        if descending:
+            clause += f" OR {expression} IS NULL"
+        return f"({clause})", [value, value, row[0]]
+
+    def _select(self, where, params, limit=None):
+        expressions = ", ".join(expression for _, expression in self.COLUMNS)
+        sql = f"SELECT r.id, {expressions} FROM {self.SOURCE}{where}{self._order_by()}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = params + [limit]
+        return self.conn.execute(sql, params).fetchall()
+
+    def _count(self, where, params):
+        return self.conn.execute(f"SELECT COUNT(*) FROM recommendations r{where}", params).fetchone()[0]
+
+    def _append(self, rows):
+        if not rows:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), len(self.rows), len(self.rows) + len(rows) - 1)
+        for row in rows:
+            self.positions[row[0]] = len(self.rows)
+            self.rows.append(row)
+        self.endInsertRows()
+
+    def _read_cursors(self):
+        """Record the data version, id cursor and latest notification time the loaded rows reflect."""
+        self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        self.max_id, self.last_notified = self.conn.execute(
+            "SELECT COALESCE(MAX(id), 0), MAX(notified_at) FROM recommendations"
+        ).fetchone()
+
+    def reload(self):
+        """Reset the model and load the first chunk for the current filter and sort order."""
+        if not self.started:
+            return
+        self.beginResetModel()
+        self.rows, self.positions, self.total = [], {}, 0
+        if self._connect():
+            self._read_cursors()
+            where, params = self._where()
+            self.total = self._count(where, params)
+            for row in self._select(where, params, self.CHUNK_SIZE):
+                self.positions[row[0]] = len(self.rows)
+                self.rows.append(row)
+        self.endResetModel()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or role != QtCore.Qt.DisplayRole:
+            return None
+        value = self.rows[index.row()][index.column() + 1]  # Column 0 is the hidden id
+        if isinstance(value, float):
+            value = round(value, 2)
+        return "" if value is None else str(value)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.COLUMNS[section][0]
+        return None
+
+    def flags(self, index):
+        # Rows are selectable but not editable
+        return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return not parent.isValid() and len(self.rows) < self.total
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        where, params = self._where(self._after(self.rows[-1]) if self.rows else None)
+        chunk = self._select(where, params, self.CHUNK_SIZE)
+        if not chunk:
+            self.total = len(self.rows)
+            return
+        self._append(chunk)
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        self.sort_column = column if 0 <= column < len(self.COLUMNS) else None
+        self.sort_order = order
+        self.reload()
+
+    def set_filter(self, text):
+        self.filter_text = text.strip()
+        self.reload()
+
+    def refresh(self):
+        """Apply changes written since the last check; returns without querying rows if nothing changed."""
+        if not self.started or not self._connect():
+            return
+        if self.data_version is None:
+            # The database only just appeared
+            self.reload()
+            return
+        if self.conn.execute("PRAGMA data_version").fetchone()[0] == self.data_version:
+            return
+
+        previous_max_id, previous_notified = self.max_id, self.last_notified
+        self._read_cursors()
+        count = self._count(" WHERE r.id <= ?", [previous_max_id])
+        if self.max_id < previous_max_id or (not self.filter_text and count < self.total):
+            # Rows were deleted; start over
+            self.reload()
+            return
+        if self.sort_column is not None:
+            self._reread_sorted()
+            return
+
+        # Rows notified since the last check, updated in place
+        if self.last_notified and self.last_notified != previous_notified:
+            extra = ("r.notified_at > ?", [previous_notified]) if previous_notified else ("r.notified_at IS NOT NULL", [])
+            where, params = self._where(extra)
+            for row in self._select(where, params):
+                position = self.positions.get(row[0])
+                if position is not None:
+                    self.rows[position] = row
+                    self.dataChanged.emit(self.index(position, 0), self.index(position, len(self.COLUMNS) - 1))
+
+        # Rows past the id cursor
+        where, params = self._where(("r.id > ?", [previous_max_id]))
+        added = self._count(where, params)
+        fully_loaded = len(self.rows) >= self.total
+        self.total += added
+        if added and fully_loaded:
+            # Everything before the new rows is on screen, so append them directly
+            self._append(self._select(where, params, self.CHUNK_SIZE))
+
+    def _reread_sorted(self):
+        """
+        New rows and new scores may land anywhere in a sorted view, so re-read as many rows as are loaded
+        and swap them in with a layout change rather than a reset, which keeps the scroll position.
+        """
+        where, params = self._where()
+        self.total = self._count(where, params)
+        if not self.rows:
+            self._append(self._select(where, params, self.CHUNK_SIZE))
+            return
+        rows = self._select(where, params, len(self.rows))
+        if len(rows) < len(self.rows):
+            # Filtered rows went away; a layout change can't drop rows
+            self.reload()
+            return
+        self.layoutAboutToBeChanged.emit()
+        self.rows = rows
+        self.positions = {row[0]: position for position, row in enumerate(rows)}
+        self.layoutChanged.emit()
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+
+
+class PipelineWorker(QtCore.QObject):
+    """Runs the pipeline and the notification digest on a QThread, reporting progress through signals."""
+    stage_changed = QtCore.pyqtSignal(str)
+    progress = QtCore.pyqtSignal(str, int)
+    failed = QtCore.pyqtSignal(str)
+    finished = QtCore.pyqtSignal(dict)
+
+    def __init__(self):
+        super().__init__()
+        self.pipeline = None
+        self.cancelled = False
+
+    def run(self):
+        stats = {}
+        try:
+            # Imported here so the window never waits on the pipeline's dependencies
+            from pipeline import Pipeline
+            from main import send_notifications
+
+            self.stage_changed.emit("Syncing library and fetching recommendations...")
+            self.pipeline = Pipeline(on_progress=self.progress.emit)
+            if self.cancelled:
+                self.pipeline.cancel()
+            stats = self.pipeline.run()
+            for error in self.pipeline.errors:
+                self.failed.emit(str(error))
+
+            if not self.cancelled and not self.pipeline.errors:
+                self.stage_changed.emit("Sending notifications...")
+                send_notifications()
+        except Exception as e:
+            self.failed.emit(str(e))
+        finally:
+            self.finished.emit(stats)
+
+    def cancel(self):
+        self.cancelled = True
+        if self.pipeline:
+            self.pipeline.cancel()
+
 
 class MediaMonitoringGUI(QtWidgets.QMainWindow):
     def __init__(self):
@@ -28,14 +311,38 @@ class MediaMonitoringGUI(QtWidgets.QMainWindow):
         self.refresh_button.triggered.connect(self.run_main_and_refresh)
         self.toolbar.addAction(self.refresh_button)
 
-        # Set up the table
-        self.table = QtWidgets.QTableWidget(self)
-        self.table.setColumnCount(4)
-        self.table.setHorizontalHeaderLabels(["Title", "Release Date", "Age Rating", "Notified At"])
+        cancel_icon = QtGui.QIcon.fromTheme("process-stop")
+        self.cancel_button = QtWidgets.QAction(cancel_icon, "Cancel", self)
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.triggered.connect(self.cancel_run)
+        self.toolbar.addAction(self.cancel_button)
+
+        # Filter box; matching is done by SQLite rather than in the view
+        self.filter_edit = QtWidgets.QLineEdit(self)
+        self.filter_edit.setPlaceholderText("Filter titles")
+        self.filter_edit.setClearButtonEnabled(True)
+        self.toolbar.addWidget(self.filter_edit)
+
+        # Apply the filter once typing pauses rather than on every keystroke
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(300)
+        self.filter_timer.timeout.connect(self.apply_filter)
+        self.filter_edit.textChanged.connect(self.filter_timer.start)
+
+        # Set up the table, backed by a lazily loading model
+        self.model = RecommendationsModel(database_path(), self)
+        self.table = QtWidgets.QTableView(self)
+        self.table.setModel(self.model)
+        # Start in insertion order, which refreshes incrementally; clicking Score shows the ranked list
+        self.table.horizontalHeader().setSortIndicator(-1, QtCore.Qt.DescendingOrder)
+        self.table.setSortingEnabled(True)
+        self.table.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.table.verticalHeader().setDefaultSectionSize(24)
         self.table.horizontalHeader().setStretchLastSection(True)
         self.table.horizontalHeader().setSectionResizeMode(QtWidgets.QHeaderView.Stretch)
         self.table.setStyleSheet("""
-            QTableWidget {
+            QTableView {
                 background-color: #2b2b2b;
                 color: #ffffff;
                 font-family: Arial, sans-serif;
@@ -48,7 +355,7 @@ class MediaMonitoringGUI(QtWidgets.QMainWindow):
                 padding: 5px;
                 border: none;
             }
-            QTableWidgetItem {
+            QTableView::item {
                 padding: 10px;
             }
         """)
@@ -56,32 +363,37 @@ class MediaMonitoringGUI(QtWidgets.QMainWindow):
         # Add table to layout
         self.layout.addWidget(self.table)
 
-        # Load initial data into the table
-        self.load_data()
+        # Status bar with run progress
+        self.status_label = QtWidgets.QLabel("Idle", self)
+        self.progress_bar = QtWidgets.QProgressBar(self)
+        self.progress_bar.setRange(0, 0)  # Busy indicator; totals aren't known up front
+        self.progress_bar.setMaximumWidth(150)
+        self.progress_bar.hide()
+        self.statusBar().addWidget(self.status_label, 1)
+        self.statusBar().addPermanentWidget(self.progress_bar)
+
+        # Background pipeline run, if one is in progress
+        self.worker_thread = None
+        self.worker = None
+        self.run_counts = {}
 
         # Set up a timer to run the main() function every hour
         self.start_background_task()
 
+        # Poll for rows written by the pipeline or the scheduler daemon; a no-op when nothing changed
+        self.change_timer = QTimer(self)
+        self.change_timer.timeout.connect(self.load_data)
+        self.change_timer.start(5000)
+
+        # First load runs once the event loop is up, after the window has been painted
+        QTimer.singleShot(0, self.model.start)
+
     def load_data(self):
-        # Clear the table first
-        self.table.setRowCount(0)
-
-        # Connect to the database and fetch records
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("SELECT title, release_date, age_rating, notified_at FROM notified_releases")
-        records = cursor.fetchall()
-
-        # Populate the table with data
-        for row_idx, row_data in enumerate(records):
-            self.table.insertRow(row_idx)
-            for col_idx, col_data in enumerate(row_data):
-                item = QtWidgets.QTableWidgetItem(str(col_data))
-                item.setFlags(item.flags() ^ QtCore.Qt.ItemIsEditable)  # Make items non-editable
-                self.table.setItem(row_idx, col_idx, item)
-
-        # Close the database connection
-        conn.close()
+        # Only rows added since the last load are fetched
+        self.model.refresh()
+
+    def apply_filter(self):
+        self.model.set_filter(self.filter_edit.text())
 
     def start_background_task(self):
         # Create a timer that triggers every hour
@@ -90,9 +402,75 @@ class MediaMonitoringGUI(QtWidgets.QMainWindow):
         self.timer.start(3600000)  # 3600000 ms = 1 hour
 
     def run_main_and_refresh(self):
-        main()          # Run the main function to fetch new data
+        """Start a pipeline run on a worker thread unless one is already running."""
+        if self.worker_thread is not None:
+            self.status_label.setText("A run is already in progress.")
+            return
+
+        self.run_counts = {}
+        self.worker_thread = QtCore.QThread(self)
+        self.worker = PipelineWorker()
+        self.worker.moveToThread(self.worker_thread)
+        self.worker_thread.started.connect(self.worker.run)
+        self.worker.stage_changed.connect(self.status_label.setText)
+        self.worker.progress.connect(self.on_progress)
+        self.worker.failed.connect(self.on_failed)
+        self.worker.finished.connect(self.on_finished)
+        self.worker_thread.finished.connect(self.worker.deleteLater)
+
+        self.refresh_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.progress_bar.show()
+        self.worker_thread.start()
+
+    def cancel_run(self):
+        if self.worker:
+            self.status_label.setText("Cancelling after the current batch...")
+            self.cancel_button.setEnabled(False)
+            self.worker.cancel()
+
+    def on_progress(self, stage, count):
+        self.run_counts[stage] = count
+        self.status_label.setText(
+            f"Media stored: {self.run_counts.get('media', 0)} | "
+            f"Recommendations stored: {self.run_counts.get('recommendations', 0)}"
+        )
+        # Show new rows as they are written rather than once at the end
+        if stage == 'recommendations':
+            self.load_data()
+
+    def on_failed(self, message):
+        self.statusBar().showMessage(f"Error: {message}", 10000)
+
+    def on_finished(self, stats):
+        cancelled = self.worker.cancelled if self.worker else False
+        self.worker_thread.quit()
+        self.worker_thread.wait()
+        self.worker_thread.deleteLater()
+        self.worker_thread = None
+        self.worker = None
+
+        self.refresh_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        self.progress_bar.hide()
+        if cancelled:
+            self.status_label.setText("Run cancelled.")
+        else:
+            self.status_label.setText(
+                f"Last run: {stats.get('media_stored', 0)} media items, "
+                f"{stats.get('recommendations_inserted', 0)} new recommendations in {stats.get('elapsed_seconds', 0)}s."
+            )
         self.load_data()  # Refresh the GUI with the updated data
 
+    def closeEvent(self, event):
+        # Let a running pipeline stop cleanly before the window goes away
+        if self.worker_thread is not None:
+            self.worker.cancel()
+            self.worker_thread.quit()
+            self.worker_thread.wait()
+        self.model.close()
+        super().closeEvent(event)
+
 if __name__ == "__main__":
     app = QtWidgets.QApplication(sys.argv)
 
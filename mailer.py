@@ -0,0 +1,132 @@
+import logging
+import queue
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import get_email_smtp_client, log_error
+from metrics import registry
+
+logging.basicConfig(level=logging.INFO)
+
+# Errors after which a pooled connection is discarded and the message retried on a fresh one.
+# SMTPException subclasses OSError, so other SMTP errors (refused recipients etc.) are checked for separately.
+RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)
+
+class SMTPMailer:
+    """
+    Small pool of authenticated SMTP connections reused for a whole batch of messages.
+    Connections are opened lazily (one TLS handshake and login each), handed to one sender at a time,
+    and replaced transparently if the server drops them.
+    """
+    def __init__(self, connect=get_email_smtp_client, pool_size=2, max_attempts=2):
+        self.connect = connect
+        self.pool_size = max(1, pool_size)
+        self.max_attempts = max_attempts
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+        self._all = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _acquire(self):
+        """Take an idle connection, opening a new one while the pool isn't full."""
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self._lock:
+                can_open = self._opened < self.pool_size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                break
+            # Wait briefly, then re-check in case a dropped connection freed a slot
+            try:
+                return self._idle.get(timeout=0.5)
+            except queue.Empty:
+                continue
+        try:
+            server = self.connect()
+        except Exception:
+            with self._lock:
+                self._opened -= 1
+            raise
+        with self._lock:
+            self._all.append(server)
+        return server
+
+    def _release(self, server):
+        self._idle.put(server)
+
+    def _discard(self, server):
+        with self._lock:
+            self._opened -= 1
+            if server in self._all:
+                self._all.remove(server)
+        try:
+            server.close()
+        except Exception:
+            pass
+
+    def send(self, message, sender, recipients):
+        """Send one message, reconnecting once if the pooled connection has gone stale."""
+        for attempt in range(1, self.max_attempts + 1):
+            server = self._acquire()
+            started = time.perf_counter()
+            try:
+                server.sendmail(sender, recipients, message.as_string())
+                registry.observe('smtp_send_duration_seconds', time.perf_counter() - started, result='ok',
+                                 help="Time to hand one message to the SMTP server.")
+            except Exception as e:
+                registry.observe('smtp_send_duration_seconds', time.perf_counter() - started, result=type(e).__name__)
+                if isinstance(e, RECONNECT_ERRORS) or (isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)):
+                    self._discard(server)
+                    if attempt == self.max_attempts:
+                        raise
+                    logging.warning(f"SMTP connection lost ({e}), reconnecting.")
+                    continue
+                # The connection itself is still usable after a per-message refusal
+                self._release(server)
+                raise
+            self._release(server)
+            return
+
+    def send_many(self, envelopes):
+        """
+        Send several messages concurrently over the pool.
+        Args:
+            envelopes (list): (message, sender, recipients) tuples.
+        Returns:
+            list: True or False for each envelope, in order.
+        """
+        def send_one(envelope):
+            message, sender, recipients = envelope
+            try:
+                self.send(message, sender, recipients)
+                return True
+            except Exception as e:
+                log_error(f"Error sending '{message['Subject']}' to {', '.join(recipients)}: {e}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix='smtp') as executor:
+            return list(executor.map(send_one, envelopes))
+
+    def close(self):
+        """Politely close every open connection."""
+        with self._lock:
+            servers, self._all = self._all, []
+            self._opened = 0
+        while not self._idle.empty():
+            self._idle.get_nowait()
+        for server in servers:
+            try:
+                server.quit()
+            except Exception:
+                server.close()
@@ -1,64 +1,347 @@
-import time
+import argparse
+import importlib.util
 import logging
-from fetch_data import JellyfinFetcher, TMDBHelper
-from database import add_media_item, add_recommendation, get_all_media_items, get_new_recommendations
-from email_notifications import send_summary_notification
-from utils import log_message, retry  # Importing custom logging and retry utilities
+import os
+import sys
+from datetime import datetime, timedelta
+from itertools import islice
+from config import get_jellyfin_config, get_pipeline_config, get_metrics_config, get_recommendations_config
+from utils import log_message, retry_metrics  # Importing custom logging and retry metrics
+from metrics import timed_stage, stage_failed, write_metrics_file, profiled
+
+# requests, aiohttp, SQLAlchemy and the email modules are imported inside the functions that use them,
+# so `--check`, the GUI and anything importing a helper from here start without loading them
 
 logging.basicConfig(level=logging.INFO)
 
-@retry(retries=3, delay=5, backoff=2)
-def fetch_and_store_media():
-    """Fetch media data from Jellyfin and store it in the database."""
+# Number of media items looked up concurrently before their recommendations are stored
+RECOMMENDATION_BATCH_SIZE = 200
+
+def needs_full_sync(folders, sync_states, interval_hours):
+    """Return True when any folder has never been fully swept or its last sweep is older than the interval."""
+    cutoff = datetime.utcnow() - timedelta(hours=interval_hours)
+    for folder in folders:
+        last_full_sync = sync_states.get(folder['id'], {}).get('last_full_sync')
+        if not last_full_sync or last_full_sync < cutoff:
+            return True
+    return False
+
+def recommendation_refresh_due():
+    """
+    Return True when every item's recommendations should be fetched again (recommendations.refresh_interval_hours;
+    0 turns refreshes off). The first run starts the clock, since it has just fetched everything.
+    """
+    from database import get_last_recommendation_refresh, mark_recommendation_refresh
+    interval_hours = float(get_recommendations_config().get('refresh_interval_hours', 168) or 0)
+    if not interval_hours:
+        return False
+    last_refresh = get_last_recommendation_refresh()
+    if not last_refresh:
+        mark_recommendation_refresh()
+        return False
+    return last_refresh < datetime.utcnow() - timedelta(hours=interval_hours)
+
+def plan_library_sync(fetcher, full_sync=None):
+    """
+    Decide between a full and an incremental sync for the fetcher's folders.
+    Returns (full_sync, since) where `since` maps folder ids to their high-water marks.
+    """
+    from database import get_sync_states
+    jellyfin_config = get_jellyfin_config()
+    sync_states = get_sync_states()
+    if full_sync is None:
+        full_sync = (not jellyfin_config.get('incremental_sync', True)
+                     or needs_full_sync(fetcher.media_folders, sync_states, jellyfin_config.get('full_sync_interval_hours', 168)))
+    since = {} if full_sync else {folder_id: state['last_saved'] for folder_id, state in sync_states.items()}
+    log_message(f"Starting {'full' if full_sync else 'incremental'} library sync.")
+    return full_sync, since
+
+def finish_library_sync(fetcher, full_sync, seen_jellyfin_ids):
+    """Advance folder watermarks and, after a complete full sweep, remove items no longer in Jellyfin."""
+    from database import update_sync_state, remove_missing_media_items
+    # Only advance the watermark of folders whose items were all stored
+    for folder in fetcher.media_folders:
+        if folder['id'] not in fetcher.failed_folders:
+            update_sync_state(folder['id'], fetcher.watermarks.get(folder['id']), full_sync=full_sync)
+
+    # Reconcile removals only when the sweep saw every folder completely
+    if full_sync and fetcher.media_folders and not fetcher.failed_folders:
+        remove_missing_media_items(seen_jellyfin_ids)
+
+@timed_stage('library_sync')
+def fetch_and_store_media(full_sync=None):
+    """
+    Fetch media data from Jellyfin and store it in the database.
+    Incremental runs only request items saved since each folder's high-water mark; a periodic
+    full sweep re-reads every folder and removes items that are no longer in Jellyfin.
+    """
     try:
+        from fetch_data import JellyfinFetcher
+        from database import upsert_media_items
+        from owned_index import track_owned_items, purge_owned_recommendations
+
         fetcher = JellyfinFetcher()
-        all_media = fetcher.fetch_all_media()
-        
-        for item in all_media:
-            if isinstance(item, dict):  # Ensuring item is a dictionary
-                log_message(f"Processing item: {item}")  # Improved logging for debugging
-                add_media_item(title=item.get('title'), media_type=item.get('type'), jellyfin_id=item.get('jellyfin_id'))
-                
-        log_message("Media data fetched and stored successfully.")
+        fetcher.fetch_media_folders()
+        full_sync, since = plan_library_sync(fetcher, full_sync)
+
+        seen_jellyfin_ids = set()
+
+        def track_seen(items):
+            for item in items:
+                seen_jellyfin_ids.add(item.get('jellyfin_id'))
+                track_owned_items([item])
+                yield item
+
+        # Items are streamed page by page and written in chunked transactions as they arrive
+        counts = upsert_media_items(track_seen(fetcher.iter_media(since=since)))
+        finish_library_sync(fetcher, full_sync, seen_jellyfin_ids)
+        if counts['inserted']:
+            # New titles in the library shouldn't still go out as recommendations
+            purge_owned_recommendations()
+
+        log_message(f"Media data fetched and stored successfully ({counts['inserted']} new, {counts['updated']} updated).")
     except Exception as e:
         log_message(f"Error fetching and storing media: {e}", level="error")
+        stage_failed()
 
-@retry(retries=3, delay=5, backoff=2)
-def fetch_and_store_recommendations():
-    """Fetch recommendations from TMDB and store them in the database."""
+def ranked_recommendations(item, results, owned=None):
+    """Recommendation rows for one media item's TMDB results, keeping TMDB's rank and skipping titles already owned."""
+    return [
+        {'media_item_id': item['id'], 'recommended_title': result['title'], 'recommended_type': result['media_type'],
+         'tmdb_id': result['tmdb_id'], 'release_date': result['release_date'], 'popularity': result['popularity'],
+         'rank': rank}
+        for rank, result in enumerate(results)
+        if not (owned is not None and owned.is_owned(result['title'], result['media_type'], result['tmdb_id']))
+    ]
+
+def lookup_recommendations(tmdb_client, items):
+    """
+    Look up recommendations for a batch of media item dicts without storing anything.
+    Returns (items whose TMDB id was just found by title search, recommendation rows without owned titles).
+    Rows carry their age rating, fetched once per distinct recommended title in the batch.
+    """
+    from owned_index import get_owned_index
+    unresolved = [item for item in items if not item['tmdb_id']]
+    results = tmdb_client.get_recommendations_many(items)
+    owned = get_owned_index()
+    resolved = [item for item in unresolved if item['tmdb_id']]
+    rows = [rec for item in items for rec in ranked_recommendations(item, results.get(item['id'], []), owned)]
+    return resolved, tmdb_client.get_certifications_many(rows)
+
+def recommend_items(tmdb_client, items):
+    """Look up recommendations for a batch of media item dicts and store them, skipping titles already owned."""
+    from database import add_recommendations, set_media_item_tmdb_id
+    resolved, rows = lookup_recommendations(tmdb_client, items)
+
+    # Save IDs found by title search so the next run goes straight to recommendations
+    for item in resolved:
+        set_media_item_tmdb_id(item['id'], item['tmdb_id'])
+
+    return add_recommendations(rows)
+
+@timed_stage('recommendations')
+def fetch_and_store_recommendations(refresh=None, added_since=None):
+    """
+    Fetch recommendations from TMDB and store them in the database.
+    Usually only items without stored recommendations are looked up; refresh=True walks every item, and by
+    default that happens once the configured refresh interval has passed.
+    """
     try:
-        tmdb_helper = TMDBHelper()
-        media_items = get_all_media_items()
+        from database import mark_recommendation_refresh
+        if refresh is None:
+            refresh = recommendation_refresh_due()
+        if refresh:
+            log_message("Refreshing recommendations for every media item.")
+
+        shard_count = int(get_recommendations_config().get('shards', 1) or 1)
+        if shard_count > 1:
+            # Split across worker processes, each with its own slice of the TMDB rate limit
+            from shards import run_sharded
+            result = run_sharded(shard_count, refresh=refresh, added_since=added_since)
+            if result['failed']:
+                stage_failed()
+            elif refresh:
+                mark_recommendation_refresh()
+            return
 
-        for item in media_items:
-            recommendations = tmdb_helper.get_recommendations(item['title'], item['type'])
-            for rec_title in recommendations:
-                add_recommendation(media_item_id=item['id'], recommended_title=rec_title)
+        from async_tmdb import AsyncTMDBClient
+        from database import iter_media_items, update_recommendation_scores
+        from owned_index import get_owned_index
 
+        tmdb_client = AsyncTMDBClient()
+        # Rebuilt once per run; items added while it runs are tracked incrementally
+        get_owned_index(refresh=True)
+        media_items = iter_media_items(without_recommendations=not refresh, added_since=added_since)
+
+        # Items are streamed and looked up concurrently in batches; each batch is stored before the next starts
+        while True:
+            batch = list(islice(media_items, RECOMMENDATION_BATCH_SIZE))
+            if not batch:
+                break
+            recommend_items(tmdb_client, batch)
+        update_recommendation_scores()
+        if refresh:
+            mark_recommendation_refresh()
+
+        cache_stats = tmdb_client.cache.stats()
+        log_message(f"TMDB cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['entries']} entries; "
+                    f"{tmdb_client.coalesced} duplicate requests coalesced.")
         log_message("Recommendations fetched and stored successfully.")
     except Exception as e:
         log_message(f"Error fetching and storing recommendations: {e}", level="error")
+        stage_failed()
 
-def main():
-    """Main function to execute media fetch and recommendation update."""
-    # Fetch and store media items with enhanced logging and retry
-    fetch_and_store_media()
-    
-    # Fetch and store recommendations with enhanced logging and retry
-    fetch_and_store_recommendations()
-    
-    # Send notification if there are new recommendations
+@timed_stage('new_item')
+def process_new_item(item):
+    """Store a single newly added Jellyfin item and fetch its recommendations right away."""
+    try:
+        from async_tmdb import AsyncTMDBClient
+        from database import upsert_media_items, get_media_item_by_jellyfin_id
+        from owned_index import track_owned_items, purge_owned_recommendations
+
+        upsert_media_items([item])
+        track_owned_items([item])
+        purge_owned_recommendations([item])
+        media_item = get_media_item_by_jellyfin_id(item['jellyfin_id'])
+        if not media_item:
+            log_message(f"New item '{item.get('title')}' could not be stored.", level="warning")
+            stage_failed()
+            return
+        counts = recommend_items(AsyncTMDBClient(), [media_item])
+        log_message(f"Stored {counts['inserted']} recommendations for new item '{media_item['title']}'.")
+    except Exception as e:
+        log_message(f"Error processing new item '{item.get('title')}': {e}", level="error")
+        stage_failed()
+
+@timed_stage('digest')
+def send_notifications():
+    """Email a digest of recommendations that haven't been notified yet, ranked by their aggregated score."""
     try:
+        from database import (get_new_recommendations, mark_recommendations_notified, update_recommendation_scores,
+                              get_recommendations_between, get_digest_backlog, update_digest_backlog)
+        from email_notifications import send_summary_notification
+
+        update_recommendation_scores()
         new_recommendations = get_new_recommendations()
         if new_recommendations:
-            send_summary_notification(new_recommendations)
+            first_id, last_id = new_recommendations[0]['id'], new_recommendations[-1]['id']
+            # Groups whose last digest failed get everything they missed, not just the new rows
+            backlog = {group: get_recommendations_between(after_id, last_id)
+                       for group, after_id in get_digest_backlog().items()}
+            sent = send_summary_notification(new_recommendations, backlog)
+            if sent is False:
+                stage_failed()
+            elif sent is not None:
+                # Rows are marked even if some groups failed; those stay in the backlog and get them with the next digest
+                mark_recommendations_notified(last_id)
+                failed = [group for group, ok in sent.items() if not ok]
+                update_digest_backlog(failed, first_id - 1)
+                if failed:
+                    log_message(f"Digests failed for {', '.join(failed)}; they'll be resent with the next digest.",
+                                level="error")
+                    stage_failed()
         else:
             log_message("No new recommendations to notify.")
     except Exception as e:
         log_message(f"Error sending notifications: {e}", level="error")
+        stage_failed()
+
+def main():
+    """Main function to execute media fetch and recommendation update."""
+    sharded = int(get_recommendations_config().get('shards', 1) or 1) > 1
+    if get_pipeline_config().get('enabled', True) and not sharded:
+        # Fetch, store and recommend concurrently; recommendations start with the first page of items
+        from pipeline import run_pipeline
+        run_pipeline()
+        # The pipeline only looks up new items; re-fetch everything once the refresh interval has passed
+        if recommendation_refresh_due():
+            fetch_and_store_recommendations(refresh=True)
+    else:
+        # Fetch and store media items; individual requests retry with backoff
+        fetch_and_store_media()
+
+        # Fetch and store recommendations, sharded across processes if configured
+        fetch_and_store_recommendations()
+    
+    # Send notification if there are new recommendations
+    send_notifications()
+
+    # Per-host retry counters and circuit state, to spot a flaky Jellyfin or TMDB
+    metrics = retry_metrics()
+    if metrics:
+        log_message(f"HTTP retry metrics: {metrics}")
+
+    # Timings, request latencies, DB throughput and cache counters for this run
+    metrics_file = get_metrics_config().get('file')
+    if metrics_file:
+        write_metrics_file(metrics_file)
+
+def parse_shard(value):
+    """argparse type for 'I/N': shard I (0-based) of N."""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected I/N, got '{value}'")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and {count - 1}")
+    return index, count
+
+def check():
+    """
+    Validate the configuration and local setup without connecting to anything or importing the heavy dependencies.
+    Prints one line per finding and returns a process exit code.
+    """
+    from config import ENV, CONFIG_PATHS, load_config, validate_config
+    try:
+        config_data = load_config()
+    except Exception as e:
+        print(f"FAIL {e}")
+        return 1
+    problems = validate_config(config_data)
+    print(f"Config: {CONFIG_PATHS.get(ENV)} ({ENV})")
+
+    # Modules are located, not imported
+    for module in ('yaml', 'requests', 'sqlalchemy', 'aiohttp'):
+        if importlib.util.find_spec(module) is None:
+            problems.append(f"Required package '{module}' is not installed.")
+
+    url = (config_data.get('database') or {}).get('url', "sqlite:///media_database.db")
+    if url.startswith("sqlite:///"):
+        directory = os.path.dirname(os.path.abspath(url.split(":///", 1)[1]))
+        if not os.access(directory, os.W_OK):
+            problems.append(f"Database directory '{directory}' is not writable.")
+
+    for problem in problems:
+        print(f"FAIL {problem}")
+    if not problems:
+        print("OK")
+    return 1 if problems else 0
 
 if __name__ == "__main__":
-    while True:
-        main()
-        log_message("Task completed. Sleeping for 24 hours.")
-        time.sleep(86400)
+    parser = argparse.ArgumentParser(description="Sync Jellyfin, fetch TMDB recommendations and send digests.")
+    parser.add_argument('--once', action='store_true', help="Run every stage once and exit instead of starting the scheduler.")
+    parser.add_argument('--check', action='store_true', help="Validate the configuration and setup, then exit.")
+    parser.add_argument('--shard', metavar='I/N', type=parse_shard,
+                        help="Fetch recommendations for shard I of N (counting from 0) and merge it, e.g. on one of N machines.")
+    parser.add_argument('--shards', metavar='N', type=int,
+                        help="Fetch recommendations in N shards across local worker processes, then exit.")
+    parser.add_argument('--profile', choices=['cprofile', 'tracemalloc'],
+                        help="Profile a single --once run and write the report to the configured profile directory.")
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(check())
+    if args.shard or args.shards:
+        from shards import run_and_merge_shard, run_sharded
+        if args.shard:
+            succeeded = run_and_merge_shard(*args.shard)
+        else:
+            succeeded = not run_sharded(args.shards)['failed']
+        sys.exit(0 if succeeded else 1)
+    if args.once:
+        metrics_config = get_metrics_config()
+        with profiled(args.profile or metrics_config.get('profile'), metrics_config.get('profile_dir', 'profiles')):
+            main()
+    else:
+        from scheduler import run_daemon
+        run_daemon()
@@ -0,0 +1,281 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import urlparse
+
+logging.basicConfig(level=logging.INFO)
+
+# Histogram upper bounds in seconds: HTTP calls and DB writes, and whole stages
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STAGE_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 1800, 3600)
+PROFILE_TOP_N = 25
+
+# Ids in URL paths would give every title its own series; a leading segment is an API version (TMDB's /3)
+_ID_SEGMENT = re.compile(r'(?<!^)/\d+(?=/|$)')
+
+class Histogram:
+    """Cumulative bucket counts, sum and count for one label set."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+class Registry:
+    """
+    Process-wide metrics: counters, gauges and histograms keyed by name and a sorted tuple of label pairs.
+    Everything is in memory and guarded by one lock; exporting renders a snapshot.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+        self.collectors = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, amount=1, help=None, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+            if help:
+                self.help.setdefault(name, help)
+
+    def set(self, name, value, help=None, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = value
+            if help:
+                self.help.setdefault(name, help)
+
+    def set_max(self, name, value, help=None, **labels):
+        """Raise a gauge to `value` if it is higher, e.g. for peak queue depths."""
+        key = self._key(name, labels)
+        with self._lock:
+            if value > self.gauges.get(key, float('-inf')):
+                self.gauges[key] = value
+            if help:
+                self.help.setdefault(name, help)
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, help=None, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+            if help:
+                self.help.setdefault(name, help)
+
+    def value(self, name, **labels):
+        """Current value of a counter, or 0."""
+        with self._lock:
+            return self.counters.get(self._key(name, labels), 0)
+
+    def register_collector(self, name, func):
+        """Include `func()` (a JSON-serialisable dict) under `name` in JSON snapshots."""
+        self.collectors[name] = func
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        """All metrics as a JSON-serialisable dict."""
+        with self._lock:
+            data = {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'gauges': [{'name': name, 'labels': dict(labels), 'value': value}
+                           for (name, labels), value in sorted(self.gauges.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), 'count': histogram.count,
+                                'sum': round(histogram.sum, 6),
+                                'buckets': dict(zip((str(bound) for bound in histogram.buckets), histogram.counts))}
+                               for (name, labels), histogram in sorted(self.histograms.items())]
+            }
+            collectors = dict(self.collectors)
+        for name, func in collectors.items():
+            try:
+                data[name] = func()
+            except Exception as e:
+                logging.debug(f"Metrics collector {name} failed: {e}")
+        return data
+
+    def render_prometheus(self):
+        """All counters, gauges and histograms in the Prometheus text exposition format."""
+        def labels_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+            return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+        lines = []
+        with self._lock:
+            for kind, series in (('counter', self.counters), ('gauge', self.gauges)):
+                names = sorted({name for name, _ in series})
+                for name in names:
+                    if name in self.help:
+                        lines.append(f"# HELP {name} {self.help[name]}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (series_name, labels), value in sorted(series.items()):
+                        if series_name == name:
+                            lines.append(f"{name}{labels_text(labels)} {value}")
+            for name in sorted({name for name, _ in self.histograms}):
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for (series_name, labels), histogram in sorted(self.histograms.items()):
+                    if series_name != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{name}_bucket{labels_text(labels, [('le', str(bound))])} {count}")
+                    lines.append(f"{name}_bucket{labels_text(labels, [('le', '+Inf')])} {histogram.count}")
+                    lines.append(f"{name}_sum{labels_text(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{labels_text(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def endpoint_label(path):
+    """Low-cardinality endpoint label for a URL path: numeric ids become {id}."""
+    return _ID_SEGMENT.sub('/{id}', path or '/')
+
+def observe_http(host, path, status, seconds):
+    """Record one outbound HTTP call; `status` is the response code or an error class name."""
+    registry.observe('http_request_duration_seconds', seconds, host=host, endpoint=endpoint_label(path), status=status,
+                     help="Outbound HTTP request latency by host, endpoint and status.")
+
+def timed_get(get, url, host, **kwargs):
+    """Call `get(url, **kwargs)` (requests.get or a Session's get) and record its latency and status."""
+    path = urlparse(url).path
+    started = time.perf_counter()
+    try:
+        response = get(url, **kwargs)
+    except Exception as e:
+        observe_http(host, path, type(e).__name__, time.perf_counter() - started)
+        raise
+    observe_http(host, path, response.status_code, time.perf_counter() - started)
+    return response
+
+def observe_db_write(table, rows, seconds):
+    """Record a bulk write and keep a running rows-per-second gauge for the table."""
+    registry.inc('db_rows_written_total', rows, table=table, help="Rows written by the bulk database APIs.")
+    registry.inc('db_write_seconds_total', seconds, table=table, help="Time spent in bulk database writes.")
+    registry.observe('db_write_duration_seconds', seconds, table=table, help="Duration of one chunked write transaction.")
+    total_rows = registry.value('db_rows_written_total', table=table)
+    total_seconds = registry.value('db_write_seconds_total', table=table)
+    if total_seconds:
+        registry.set('db_rows_per_second', round(total_rows / total_seconds, 1), table=table,
+                     help="Rows written per second of write time, cumulative.")
+
+# Stages running on each thread, innermost last, so stage_failed() knows which run to mark
+_running_stages = threading.local()
+
+@contextmanager
+def stage_timer(stage):
+    """Time a pipeline stage and count its runs by outcome; it's an error if it raises or calls stage_failed()."""
+    started = time.perf_counter()
+    outcome = 'error'
+    run = {'failed': False}
+    stack = _running_stages.__dict__.setdefault('stack', [])
+    stack.append(run)
+    try:
+        yield
+        outcome = 'error' if run['failed'] else 'ok'
+    finally:
+        stack.pop()
+        elapsed = time.perf_counter() - started
+        registry.observe('stage_duration_seconds', elapsed, buckets=STAGE_BUCKETS, stage=stage,
+                         help="Wall time of each pipeline stage run.")
+        registry.inc('stage_runs_total', stage=stage, outcome=outcome, help="Stage runs by outcome.")
+        registry.set('stage_last_duration_seconds', round(elapsed, 3), stage=stage,
+                     help="Wall time of the most recent run of each stage.")
+        logging.info(f"Stage {stage} took {elapsed:.2f}s")
+
+def stage_failed():
+    """Count the innermost running stage on this thread as failed, for stages that log errors instead of raising."""
+    stack = getattr(_running_stages, 'stack', None)
+    if stack:
+        stack[-1]['failed'] = True
+
+def timed_stage(stage):
+    """Decorator form of stage_timer."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def write_metrics_file(path):
+    """Write a JSON snapshot of every metric, e.g. once per run."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    snapshot = registry.snapshot()
+    snapshot['written_at'] = time.time()
+    with open(path, 'w') as file:
+        json.dump(snapshot, file, indent=2, default=str)
+    logging.info(f"Metrics written to {path}")
+
+@contextmanager
+def profiled(mode, output_dir='profiles'):
+    """
+    Opt-in profiling around a block: 'cprofile' dumps a .prof file (open it with pstats or snakeviz),
+    'tracemalloc' writes the top allocation sites and peak traced memory. Any other mode does nothing.
+    """
+    if mode not in ('cprofile', 'tracemalloc'):
+        yield
+        return
+    # Profilers are only imported when asked for
+    import cProfile
+    import io
+    import pstats
+    import tracemalloc
+    os.makedirs(output_dir, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            path = os.path.join(output_dir, f"run-{stamp}.prof")
+            profiler.dump_stats(path)
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+            logging.info(f"cProfile written to {path}\n{summary.getvalue()}")
+    else:
+        tracemalloc.start(10)
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            path = os.path.join(output_dir, f"run-{stamp}.tracemalloc.txt")
+            with open(path, 'w') as file:
+                file.write(f"current={current} bytes peak={peak} bytes\n")
+                for stat in snapshot.statistics('lineno')[:PROFILE_TOP_N]:
+                    file.write(f"{stat}\n")
+            logging.info(f"tracemalloc report written to {path} (peak {peak / 1024 / 1024:.1f} MiB)")
@@ -0,0 +1,137 @@
+import logging
+import threading
+from config import get_recommendations_config
+from database import iter_media_items, iter_unnotified_recommendations, delete_recommendations
+from utils import standardize_title, log_message
+
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_FUZZY_THRESHOLD = 0.85
+
+def trigrams(normalized_title):
+    """Character trigrams of a standardized title, padded so short titles and word starts still count."""
+    padded = f"  {normalized_title} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class OwnedTitleIndex:
+    """
+    In-memory index of titles already in the library.
+    Titles are keyed by their standardized form (and TMDB id where known), so "already owned" is a set lookup
+    instead of a comparison against every media item. An optional trigram index adds fuzzy matching for
+    near-identical titles ("Spider-Man: Homecoming" vs "Spiderman Homecoming").
+    """
+    def __init__(self, fuzzy=False, threshold=DEFAULT_FUZZY_THRESHOLD):
+        self.fuzzy = fuzzy
+        self.threshold = threshold
+        self.titles = {}  # standardized title -> set of media types
+        self.tmdb_ids = set()  # (media type, TMDB id)
+        self.postings = {}  # trigram -> set of standardized titles
+        self.gram_counts = {}  # standardized title -> number of distinct trigrams
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.titles)
+
+    def add(self, title, media_type=None, tmdb_id=None):
+        """Add one library item to the index."""
+        normalized = standardize_title(title)
+        with self._lock:
+            if tmdb_id:
+                self.tmdb_ids.add((media_type, tmdb_id))
+            if not normalized:
+                return
+            types = self.titles.setdefault(normalized, set())
+            types.add(media_type)
+            if self.fuzzy and normalized not in self.gram_counts:
+                grams = trigrams(normalized)
+                self.gram_counts[normalized] = len(grams)
+                for gram in grams:
+                    self.postings.setdefault(gram, set()).add(normalized)
+
+    def add_many(self, items):
+        """Add media item dicts ('title', 'type' and optional 'tmdb_id') to the index."""
+        for item in items:
+            self.add(item.get('title'), item.get('type'), item.get('tmdb_id'))
+
+    def is_owned(self, title, media_type=None, tmdb_id=None):
+        """Return True if the title (or TMDB id) is already in the library, optionally only for one media type."""
+        if tmdb_id and (media_type, tmdb_id) in self.tmdb_ids:
+            return True
+        normalized = standardize_title(title)
+        if not normalized:
+            return False
+        with self._lock:
+            types = self.titles.get(normalized)
+            if types and (media_type is None or media_type in types or None in types):
+                return True
+            return self.fuzzy and self._fuzzy_match(normalized, media_type)
+
+    def _fuzzy_match(self, normalized, media_type):
+        """Jaccard similarity over trigrams against titles sharing at least one trigram. Caller holds the lock."""
+        grams = trigrams(normalized)
+        shared = {}
+        for gram in grams:
+            for candidate in self.postings.get(gram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        for candidate, count in shared.items():
+            similarity = count / (len(grams) + self.gram_counts[candidate] - count)
+            if similarity >= self.threshold:
+                types = self.titles[candidate]
+                if media_type is None or media_type in types or None in types:
+                    return True
+        return False
+
+    @classmethod
+    def from_database(cls, fuzzy=False, threshold=DEFAULT_FUZZY_THRESHOLD):
+        """Build the index from every stored media item, streamed in chunks."""
+        index = cls(fuzzy=fuzzy, threshold=threshold)
+        index.add_many(iter_media_items())
+        return index
+
+# Process-wide index, built on first use and kept current as items are stored
+_index = None
+_index_lock = threading.Lock()
+
+def get_owned_index(refresh=False):
+    """
+    Return the shared owned-title index, or None when filtering is disabled in the 'recommendations' section.
+    Pass refresh=True to rebuild it from the database (e.g. at the start of a full recommendation run).
+    """
+    global _index
+    recommendations_config = get_recommendations_config()
+    if not recommendations_config.get('filter_owned', True):
+        return None
+    with _index_lock:
+        if _index is None or refresh:
+            _index = OwnedTitleIndex.from_database(
+                fuzzy=recommendations_config.get('fuzzy_matching', False),
+                threshold=float(recommendations_config.get('fuzzy_threshold', DEFAULT_FUZZY_THRESHOLD))
+            )
+            log_message(f"Owned-title index built with {len(_index)} titles.")
+        return _index
+
+def track_owned_items(items):
+    """Add newly stored media items to the shared index if it has been built; otherwise it's built from the database later."""
+    if _index is not None:
+        _index.add_many(items)
+
+def purge_owned_recommendations(items=None):
+    """
+    Delete unsent recommendations whose title is now in the library, e.g. after a sync or webhook stored new items.
+    Pass the new `items` to check against just those; otherwise the whole shared index is used. Returns the number deleted.
+    """
+    recommendations_config = get_recommendations_config()
+    if not recommendations_config.get('filter_owned', True):
+        return 0
+    if items is None:
+        index = get_owned_index()
+    else:
+        index = OwnedTitleIndex(fuzzy=recommendations_config.get('fuzzy_matching', False),
+                                threshold=float(recommendations_config.get('fuzzy_threshold', DEFAULT_FUZZY_THRESHOLD)))
+        index.add_many(items)
+    owned_ids = [rec['id'] for rec in iter_unnotified_recommendations()
+                 if index.is_owned(rec['recommended_title'], rec['recommended_type'], rec['tmdb_id'])]
+    deleted = delete_recommendations(owned_ids)
+    if deleted:
+        log_message(f"Removed {deleted} unsent recommendations for titles now in the library.")
+    return deleted
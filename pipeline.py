@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from async_tmdb import AsyncTMDBClient
+from config import get_pipeline_config
+from database import (upsert_media_items, add_recommendations, iter_media_items, get_media_items_by_jellyfin_ids,
+                      set_media_item_tmdb_id, update_recommendation_scores)
+from fetch_data import JellyfinFetcher
+from main import plan_library_sync, finish_library_sync, ranked_recommendations
+from owned_index import get_owned_index, purge_owned_recommendations
+from utils import log_message
+from metrics import registry, stage_timer, stage_failed
+
+logging.basicConfig(level=logging.INFO)
+
+# Marks the end of a stage's output
+DONE = object()
+
+class Pipeline:
+    """
+    Runs fetch -> store media -> recommend -> store recommendations as concurrent stages joined by bounded queues.
+    A full queue blocks its producer, so a slow stage throttles everything upstream instead of buffering
+    the library in memory, and recommendations for the first page are stored while later pages download.
+    """
+    def __init__(self, queue_size=None, tmdb_workers=None, media_batch_size=None, writer_batch_size=None, on_progress=None):
+        pipeline_config = get_pipeline_config()
+        queue_size = int(queue_size or pipeline_config.get('queue_size', 1000))
+        self.tmdb_workers = int(tmdb_workers or pipeline_config.get('tmdb_workers', 20))
+        self.media_batch_size = int(media_batch_size or pipeline_config.get('media_batch_size', 500))
+        self.writer_batch_size = int(writer_batch_size or pipeline_config.get('writer_batch_size', 500))
+
+        self.media_queue = queue.Queue(maxsize=queue_size)
+        self.resolve_queue = queue.Queue(maxsize=queue_size)
+        self.result_queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.cancelled = False
+        self.errors = []
+        self.stats = {'media_fetched': 0, 'media_stored': 0, 'media_inserted': 0, 'items_recommended': 0,
+                      'recommendations_owned': 0, 'recommendations_inserted': 0, 'tmdb_coalesced': 0, 'max_queue_depth': {}}
+        self.owned = None
+        # Called from stage threads as on_progress(stage, count) after each batch is written
+        self.on_progress = on_progress
+
+    def cancel(self):
+        """Stop every stage after its current batch; work already written is kept."""
+        self.cancelled = True
+        self.stop_event.set()
+
+    def _report(self, stage, count):
+        if self.on_progress:
+            try:
+                self.on_progress(stage, count)
+            except Exception as e:
+                logging.debug(f"Progress callback failed: {e}")
+
+    def _put(self, q, item):
+        """Blocking put that gives up once the pipeline has been stopped."""
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q, name):
+        """Blocking get that returns DONE once the pipeline has been stopped."""
+        while not self.stop_event.is_set():
+            try:
+                item = q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            depth = self.stats['max_queue_depth']
+            depth[name] = max(depth.get(name, 0), q.qsize() + 1)
+            registry.set('pipeline_queue_depth', q.qsize(), queue=name, help="Items waiting in a pipeline queue.")
+            registry.set_max('pipeline_queue_depth_max', q.qsize() + 1, queue=name, help="Deepest a pipeline queue has been.")
+            return item
+        return DONE
+
+    def _stage(self, func, *args):
+        """Run a stage, stopping the whole pipeline if it fails."""
+        try:
+            func(*args)
+        except Exception as e:
+            log_message(f"Pipeline stage {func.__name__} failed: {e}", level="error")
+            self.errors.append(e)
+            self.stop_event.set()
+
+    def _fetch_media(self, fetcher, since):
+        for item in fetcher.iter_media(since=since):
+            if self.stop_event.is_set():
+                return
+            self._put(self.media_queue, item)
+            self.stats['media_fetched'] += 1
+        self._put(self.media_queue, DONE)
+
+    def _store_media(self, fetcher, full_sync):
+        seen_jellyfin_ids = set()
+        queued_ids = set()
+        finished = False
+        while not finished:
+            # Take whatever has arrived, up to one batch, so writes keep pace with the fetch
+            batch = []
+            item = self._get(self.media_queue, 'media')
+            while item is not DONE:
+                batch.append(item)
+                if len(batch) >= self.media_batch_size:
+                    break
+                try:
+                    item = self.media_queue.get_nowait()
+                except queue.Empty:
+                    break
+            finished = item is DONE
+
+            if batch:
+                counts = upsert_media_items(batch, chunk_size=self.media_batch_size)
+                self.stats['media_inserted'] += counts['inserted']
+                self.stats['media_stored'] += len(batch)
+                self._report('media', self.stats['media_stored'])
+                if self.owned is not None:
+                    self.owned.add_many(batch)
+                jellyfin_ids = [item['jellyfin_id'] for item in batch if item.get('jellyfin_id')]
+                seen_jellyfin_ids.update(jellyfin_ids)
+                for media_item in get_media_items_by_jellyfin_ids(jellyfin_ids, without_recommendations=True):
+                    queued_ids.add(media_item['id'])
+                    self._put(self.resolve_queue, media_item)
+
+        if self.stop_event.is_set():
+            return
+        finish_library_sync(fetcher, full_sync, seen_jellyfin_ids)
+
+        # Pick up items from earlier runs that still have no recommendations
+        for media_item in iter_media_items(without_recommendations=True):
+            if media_item['id'] not in queued_ids:
+                self._put(self.resolve_queue, media_item)
+        self._put(self.resolve_queue, DONE)
+
+    def _recommend(self):
+        asyncio.run(self._recommend_async())
+        self._put(self.result_queue, DONE)
+
+    async def _recommend_async(self):
+        inbox = asyncio.Queue(maxsize=self.tmdb_workers)
+
+        async def feed():
+            while True:
+                item = await asyncio.to_thread(self._get, self.resolve_queue, 'resolve')
+                if item is DONE:
+                    break
+                await inbox.put(item)
+            for _ in range(self.tmdb_workers):
+                await inbox.put(DONE)
+
+        async def work(client):
+            while True:
+                item = await inbox.get()
+                if item is DONE:
+                    return
+                resolved = False
+                if not item['tmdb_id']:
+                    item['tmdb_id'] = await client.resolve_tmdb_id(item['title'], item['type'])
+                    resolved = bool(item['tmdb_id'])
+                results = []
+                if item['tmdb_id']:
+                    results = await client.get_recommendations(item['title'], item['type'], item['tmdb_id'])
+                # Titles already in the library never reach the writer, nor cost a certification lookup
+                recommendations = ranked_recommendations(item, results, self.owned)
+                self.stats['recommendations_owned'] += len(results) - len(recommendations)
+                await client.certifications_many(recommendations)
+                await asyncio.to_thread(self._put, self.result_queue, (item, resolved, recommendations))
+
+        async with AsyncTMDBClient(max_concurrency=self.tmdb_workers) as client:
+            await asyncio.gather(feed(), *(work(client) for _ in range(self.tmdb_workers)))
+        self.stats['tmdb_coalesced'] = client.coalesced
+
+    def _store_recommendations(self):
+        rows = []
+
+        def flush():
+            if rows:
+                counts = add_recommendations(rows, chunk_size=self.writer_batch_size)
+                self.stats['recommendations_inserted'] += counts['inserted']
+                rows.clear()
+                self._report('recommendations', self.stats['recommendations_inserted'])
+
+        while not self.stop_event.is_set():
+            try:
+                result = self.result_queue.get(timeout=1.0)
+            except queue.Empty:
+                # Nothing arriving; write what we have so progress is visible
+                flush()
+                continue
+            if result is DONE:
+                break
+            item, resolved, recommendations = result
+            if resolved:
+                set_media_item_tmdb_id(item['id'], item['tmdb_id'])
+            rows.extend(recommendations)
+            self.stats['items_recommended'] += 1
+            if len(rows) >= self.writer_batch_size:
+                flush()
+        flush()
+
+    def run(self, full_sync=None):
+        """Run every stage to completion and return the pipeline's stats."""
+        started = time.monotonic()
+        fetcher = JellyfinFetcher()
+        fetcher.fetch_media_folders()
+        full_sync, since = plan_library_sync(fetcher, full_sync)
+        self.owned = get_owned_index(refresh=True)
+
+        threads = [
+            threading.Thread(target=self._stage, args=(self._fetch_media, fetcher, since), name='pipeline-fetch'),
+            threading.Thread(target=self._stage, args=(self._store_media, fetcher, full_sync), name='pipeline-media'),
+            threading.Thread(target=self._stage, args=(self._recommend,), name='pipeline-tmdb'),
+            threading.Thread(target=self._stage, args=(self._store_recommendations,), name='pipeline-writer')
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Items are recommended while later pages are still being stored, so a title owned further on in the library
+        # may have been recommended before it reached the index; drop those now that the index is complete
+        if self.owned is not None:
+            self.stats['recommendations_owned'] += purge_owned_recommendations()
+
+        # Fold this run's rows into the per-title scores
+        self.stats['recommendations_scored'] = update_recommendation_scores()
+        self.stats['elapsed_seconds'] = round(time.monotonic() - started, 3)
+        self.stats['errors'] = len(self.errors)
+        self.stats['cancelled'] = self.cancelled
+        log_message(f"Pipeline finished: {self.stats}")
+        return self.stats
+
+def run_pipeline(full_sync=None):
+    """Sync the library and fetch recommendations as one pipelined run."""
+    with stage_timer('pipeline'):
+        stats = Pipeline().run(full_sync)
+        if stats['errors']:
+            stage_failed()
+        return stats
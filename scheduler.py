@@ -0,0 +1,239 @@
+import json
+import logging
+import random
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue, Empty
+from config import get_scheduler_config, get_metrics_config
+from main import fetch_and_store_media, fetch_and_store_recommendations, send_notifications, process_new_item
+from utils import log_message
+from metrics import registry, write_metrics_file
+
+logging.basicConfig(level=logging.INFO)
+
+# Jellyfin item types that map onto TMDB movie/tv entries
+WEBHOOK_ITEM_TYPES = {'Movie': 'movie', 'Series': 'tv'}
+# Jellyfin's notifications are a few KB
+MAX_WEBHOOK_BODY = 64 * 1024
+
+class JobQueue:
+    """Single worker thread running queued jobs one at a time; a job already waiting isn't queued twice."""
+    def __init__(self, name, stop_event):
+        self.name = name
+        self.stop_event = stop_event
+        self.jobs = Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, key, func, *args, on_done=None):
+        """Queue `func(*args)` under `key`. Returns False if a job with that key is already waiting."""
+        with self.lock:
+            if key in self.pending:
+                return False
+            self.pending.add(key)
+        self.jobs.put((key, func, args, on_done))
+        return True
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            try:
+                key, func, args, on_done = self.jobs.get(timeout=0.5)
+            except Empty:
+                continue
+            with self.lock:
+                self.pending.discard(key)
+            started = time.monotonic()
+            try:
+                func(*args)
+            except Exception as e:
+                log_message(f"Job {key} failed: {e}", level="error")
+            finally:
+                log_message(f"Job {key} finished in {time.monotonic() - started:.1f}s.")
+                if on_done:
+                    on_done()
+
+    def join(self, timeout=None):
+        self.thread.join(timeout)
+
+class Scheduler:
+    """
+    Runs the pipeline stages on their own jittered intervals.
+    Stages share one worker so cycles never overlap, and each stage's next run is scheduled from when its
+    previous run finished. Webhook-triggered items use a second worker so they aren't stuck behind a long sync.
+    """
+    def __init__(self, stages, jitter_seconds=0):
+        self.stages = stages  # {name: (func, interval in seconds)}
+        self.jitter_seconds = jitter_seconds
+        self.stop_event = threading.Event()
+        self.stage_queue = JobQueue('stages', self.stop_event)
+        self.item_queue = JobQueue('items', self.stop_event)
+        # Every stage runs once at startup
+        self.next_run = {name: time.monotonic() for name in stages}
+        self.lock = threading.Lock()
+
+    def _reschedule(self, name):
+        interval = self.stages[name][1]
+        with self.lock:
+            self.next_run[name] = time.monotonic() + interval + random.uniform(0, self.jitter_seconds)
+        metrics_file = get_metrics_config().get('file')
+        if metrics_file:
+            try:
+                write_metrics_file(metrics_file)
+            except OSError as e:
+                log_message(f"Could not write metrics file: {e}", level="warning")
+
+    def submit_item(self, item):
+        """Queue the recommendation lookup for a single new item."""
+        return self.item_queue.submit(('item', item['jellyfin_id']), process_new_item, item)
+
+    def run(self):
+        """Dispatch due stages until stop() is called, then wait for the running job to finish."""
+        self.stage_queue.start()
+        self.item_queue.start()
+        while not self.stop_event.wait(1.0):
+            now = time.monotonic()
+            for name, (func, _) in self.stages.items():
+                with self.lock:
+                    due = self.next_run[name] <= now
+                    if due:
+                        # Parked until the run finishes and reschedules it
+                        self.next_run[name] = float('inf')
+                if due:
+                    self.stage_queue.submit(('stage', name), func, on_done=lambda name=name: self._reschedule(name))
+        self.stage_queue.join()
+        self.item_queue.join()
+
+    def stop(self):
+        self.stop_event.set()
+
+class WebhookServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, scheduler, token=None):
+        super().__init__(address, WebhookHandler)
+        self.scheduler = scheduler
+        self.token = token
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accepts Jellyfin webhook plugin notifications on POST /webhook and serves GET /metrics and /metrics.json."""
+    # Seconds a client may stall mid-request before its connection is dropped
+    timeout = 10
+
+    def _authorized(self, query):
+        return not self.server.token or self.headers.get('X-Webhook-Token') == self.server.token \
+            or f"token={self.server.token}" in query.split('&')
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path not in ('/metrics', '/metrics.json'):
+            self._reply(404, "Not found")
+            return
+        if not self._authorized(query):
+            self._reply(403, "Forbidden")
+            return
+        if path == '/metrics':
+            self._reply(200, registry.render_prometheus(), 'text/plain; version=0.0.4')
+        else:
+            self._reply(200, json.dumps(registry.snapshot(), default=str), 'application/json')
+
+    def do_POST(self):
+        path, _, query = self.path.partition('?')
+        if path != '/webhook':
+            self._reply(404, "Not found")
+            return
+        if not self._authorized(query):
+            self._reply(403, "Forbidden")
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._reply(400, "Invalid Content-Length")
+            return
+        if length > MAX_WEBHOOK_BODY:
+            self._reply(413, "Payload too large")
+            return
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._reply(400, "Invalid JSON")
+            return
+
+        item = item_from_webhook(payload)
+        if item:
+            queued = self.server.scheduler.submit_item(item)
+            log_message(f"Webhook: new item '{item['title']}' {'queued' if queued else 'already queued'}.")
+        self._reply(202, "Accepted")
+
+    def _reply(self, status, message, content_type='text/plain'):
+        body = message.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Webhook {self.address_string()}: {format % args}")
+
+def item_from_webhook(payload):
+    """Build a media item dict from an 'ItemAdded' webhook payload, or None if it isn't one we track."""
+    if not isinstance(payload, dict) or payload.get('NotificationType') != 'ItemAdded':
+        return None
+    media_type = WEBHOOK_ITEM_TYPES.get(payload.get('ItemType'))
+    if not media_type or not payload.get('ItemId') or not payload.get('Name'):
+        return None
+    try:
+        tmdb_id = int(payload.get('Provider_tmdb'))
+    except (TypeError, ValueError):
+        tmdb_id = None
+    return {
+        'title': payload['Name'],
+        'jellyfin_id': payload['ItemId'],
+        'type': media_type,
+        'tmdb_id': tmdb_id
+    }
+
+def run_daemon():
+    """Run the scheduler (and webhook listener, if enabled) until SIGINT/SIGTERM."""
+    scheduler_config = get_scheduler_config()
+    stages = {
+        'library_sync': (fetch_and_store_media, scheduler_config.get('sync_interval_minutes', 60) * 60),
+        'recommendations': (fetch_and_store_recommendations, scheduler_config.get('recommendations_interval_minutes', 60) * 60),
+        'digest': (send_notifications, scheduler_config.get('digest_interval_minutes', 1440) * 60)
+    }
+    scheduler = Scheduler(stages, jitter_seconds=scheduler_config.get('jitter_seconds', 120))
+
+    webhook_server = None
+    webhook_config = scheduler_config.get('webhook', {}) or {}
+    if webhook_config.get('enabled', True):
+        address = (webhook_config.get('host', '127.0.0.1'), int(webhook_config.get('port', 8099)))
+        webhook_server = WebhookServer(address, scheduler, token=webhook_config.get('token') or None)
+        threading.Thread(target=webhook_server.serve_forever, name='webhook', daemon=True).start()
+        log_message(f"Listening for Jellyfin webhooks on http://{address[0]}:{address[1]}/webhook (metrics on /metrics)")
+
+    def shutdown(signum, frame):
+        log_message("Shutting down after the current job finishes.")
+        scheduler.stop()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    try:
+        scheduler.run()
+    finally:
+        if webhook_server:
+            webhook_server.shutdown()
+            webhook_server.server_close()
+        log_message("Scheduler stopped.")
+
+if __name__ == "__main__":
+    run_daemon()
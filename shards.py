@@ -0,0 +1,239 @@
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+from config import get_config, set_config, get_tmdb_config, get_recommendations_config
+from utils import log_message
+from metrics import stage_timer, stage_failed
+
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_SHARD_DIR = "shards"
+# Staged rows read per merge chunk
+MERGE_CHUNK_SIZE = 5000
+# Recommendation row fields kept in a staging file, in column order
+STAGED_FIELDS = ('media_item_id', 'recommended_title', 'rank', 'recommended_type', 'tmdb_id', 'release_date',
+                 'popularity', 'age_rating')
+
+class ShardStore:
+    """
+    Staging file for one shard's results.
+    A shard only reads the main database; its recommendation rows, TMDB ids found by title search and the
+    ids of items it has looked up go here, one transaction per batch. Age ratings are filled in at merge
+    time. A shard that dies part-way resumes from the items already staged, and the parent merges
+    completed files one at a time so the main database only ever has one writer.
+    """
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS items (media_item_id INTEGER PRIMARY KEY, resolved_tmdb_id INTEGER);"
+            "CREATE TABLE IF NOT EXISTS recommendations ("
+            " media_item_id INTEGER NOT NULL, recommended_title TEXT NOT NULL, rank INTEGER, recommended_type TEXT,"
+            " tmdb_id INTEGER, release_date TEXT, popularity REAL, age_rating TEXT,"
+            " PRIMARY KEY (media_item_id, recommended_title));"
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);"
+        )
+
+    @property
+    def completed(self):
+        return self._conn.execute("SELECT 1 FROM state WHERE key = 'completed_at'").fetchone() is not None
+
+    def processed_ids(self):
+        """Ids of the media items this shard has already looked up."""
+        return {row[0] for row in self._conn.execute("SELECT media_item_id FROM items")}
+
+    def add_batch(self, items, resolved, rows):
+        """Stage one looked-up batch: every item in it, the TMDB ids found by search, and its recommendation rows."""
+        resolved_ids = {item['id']: item['tmdb_id'] for item in resolved}
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO items (media_item_id, resolved_tmdb_id) VALUES (?, ?)",
+                [(item['id'], resolved_ids.get(item['id'])) for item in items]
+            )
+            self._conn.executemany(
+                f"INSERT OR IGNORE INTO recommendations ({', '.join(STAGED_FIELDS)}) VALUES ({', '.join('?' * len(STAGED_FIELDS))})",
+                [tuple(row.get(field) for field in STAGED_FIELDS) for row in rows]
+            )
+
+    def mark_completed(self):
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('completed_at', ?)", (str(time.time()),))
+
+    def counts(self):
+        return {
+            'items': self._conn.execute("SELECT COUNT(*) FROM items").fetchone()[0],
+            'resolved': self._conn.execute("SELECT COUNT(*) FROM items WHERE resolved_tmdb_id IS NOT NULL").fetchone()[0],
+            'recommendations': self._conn.execute("SELECT COUNT(*) FROM recommendations").fetchone()[0]
+        }
+
+    def iter_recommendation_chunks(self):
+        cursor = self._conn.execute(f"SELECT {', '.join(STAGED_FIELDS)} FROM recommendations")
+        while True:
+            chunk = cursor.fetchmany(MERGE_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield [dict(zip(STAGED_FIELDS, row)) for row in chunk]
+
+    def iter_resolved(self):
+        return iter(self._conn.execute(
+            "SELECT media_item_id, resolved_tmdb_id FROM items WHERE resolved_tmdb_id IS NOT NULL"
+        ).fetchall())
+
+    def close(self):
+        self._conn.close()
+
+def shard_path(index, count):
+    """Staging file for shard `index` of `count`; the count is part of the name so different splits never mix."""
+    shard_dir = get_recommendations_config().get('shard_dir') or DEFAULT_SHARD_DIR
+    return os.path.join(shard_dir, f"shard-{index}-of-{count}.db")
+
+def shard_rate_limit(count):
+    """TMDB requests per second for one shard: the configured per-shard budget, or an even split of the global one."""
+    from async_tmdb import DEFAULT_RATE_LIMIT
+    configured = float(get_recommendations_config().get('shard_rate_limit') or 0)
+    return configured or float(get_tmdb_config().get('rate_limit', DEFAULT_RATE_LIMIT)) / count
+
+def run_shard(index, count, refresh=False, added_since=None):
+    """
+    Look up recommendations for the media items in shard `index` of `count` and stage them.
+    Items are assigned by id modulo `count`, so a shard always covers the same items. Returns the shard's counts.
+    """
+    from async_tmdb import AsyncTMDBClient, DEFAULT_MAX_CONCURRENCY
+    from database import iter_media_items
+    from owned_index import get_owned_index
+    from main import RECOMMENDATION_BATCH_SIZE, lookup_recommendations
+
+    started = time.monotonic()
+    store = ShardStore(shard_path(index, count))
+    try:
+        if store.completed:
+            log_message(f"Shard {index}/{count} already completed; waiting to be merged.")
+            return dict(store.counts(), shard=index, elapsed_seconds=0.0)
+
+        max_concurrency = int(get_tmdb_config().get('max_concurrency', DEFAULT_MAX_CONCURRENCY))
+        # Certifications are looked up by the merging process, so titles shared between shards are looked up once
+        tmdb_client = AsyncTMDBClient(rate_limit=shard_rate_limit(count), max_concurrency=max(1, max_concurrency // count),
+                                      fetch_certifications=False)
+        get_owned_index(refresh=True)
+        processed = store.processed_ids()
+        if processed:
+            log_message(f"Shard {index}/{count} resuming after {len(processed)} items.")
+        media_items = (item for item in iter_media_items(without_recommendations=not refresh, added_since=added_since,
+                                                         shard=(index, count))
+                       if item['id'] not in processed)
+
+        while True:
+            batch = list(islice(media_items, RECOMMENDATION_BATCH_SIZE))
+            if not batch:
+                break
+            resolved, rows = lookup_recommendations(tmdb_client, batch)
+            store.add_batch(batch, resolved, rows)
+        store.mark_completed()
+
+        counts = dict(store.counts(), shard=index, tmdb_coalesced=tmdb_client.coalesced,
+                      elapsed_seconds=round(time.monotonic() - started, 3))
+        log_message(f"Shard {index}/{count} finished: {counts}")
+        return counts
+    finally:
+        store.close()
+
+def merge_shard(index, count, tmdb_client=None):
+    """
+    Copy a completed shard's staged rows into the main database, with their age ratings, and remove its staging file.
+    Pass the same `tmdb_client` for every shard so each distinct title's certification is looked up once.
+    Inserts skip rows that already exist, so merging the same file twice is harmless. Returns False if the
+    shard hasn't completed.
+    """
+    from async_tmdb import AsyncTMDBClient
+    from database import add_recommendations, set_media_item_tmdb_id
+    path = shard_path(index, count)
+    if not os.path.exists(path):
+        return False
+    store = ShardStore(path)
+    try:
+        if not store.completed:
+            log_message(f"Shard {index}/{count} hasn't completed; rerun it with --shard {index}/{count}.", level="warning")
+            return False
+        for media_item_id, tmdb_id in store.iter_resolved():
+            set_media_item_tmdb_id(media_item_id, tmdb_id)
+        tmdb_client = tmdb_client or AsyncTMDBClient(rate_limit=shard_rate_limit(count))
+        counts = {'inserted': 0, 'skipped': 0}
+        for chunk in store.iter_recommendation_chunks():
+            for key, value in add_recommendations(tmdb_client.get_certifications_many(chunk)).items():
+                counts[key] += value
+    finally:
+        store.close()
+    os.remove(path)
+    log_message(f"Merged shard {index}/{count}: {counts['inserted']} recommendations inserted.")
+    return True
+
+def run_and_merge_shard(index, count, refresh=False, added_since=None):
+    """Run one shard in this process and merge it, e.g. one machine of `count`. Returns True on success."""
+    from database import update_recommendation_scores
+    with stage_timer('recommendation_shard'):
+        try:
+            run_shard(index, count, refresh=refresh, added_since=added_since)
+        except Exception as e:
+            log_message(f"Shard {index}/{count} failed: {e}", level="error")
+            stage_failed()
+            return False
+        merged = merge_shard(index, count)
+        update_recommendation_scores()
+        if not merged:
+            stage_failed()
+        return merged
+
+def _init_worker(config_data):
+    # Workers are spawned fresh, so hand them the parent's configuration (including any in-memory overrides)
+    set_config(config_data)
+
+def run_sharded(count, processes=None, refresh=False, added_since=None):
+    """
+    Run all `count` shards across a local process pool, then merge the completed ones in this process.
+    Returns {'merged': [...], 'failed': [...]} shard indexes; a failed shard keeps its staging file and
+    picks up where it stopped when run again, without redoing the shards that were merged.
+    """
+    from async_tmdb import AsyncTMDBClient, DEFAULT_RATE_LIMIT
+    from database import update_recommendation_scores
+    configured = int(get_recommendations_config().get('shard_processes') or 0)
+    processes = processes or configured or count
+    result = {'merged': [], 'failed': []}
+
+    with stage_timer('recommendation_shards'):
+        log_message(f"Running {count} recommendation shards on {min(processes, count)} processes.")
+        completed = []
+        # Spawned rather than forked so no database or cache connection is shared with the parent
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                                 initializer=_init_worker, initargs=(get_config(),)) as pool:
+            futures = {pool.submit(run_shard, index, count, refresh, added_since): index for index in range(count)}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    log_message(f"Shard {index}/{count} failed: {e}", level="error")
+                    result['failed'].append(index)
+                    continue
+                completed.append(index)
+
+        # No shard is using TMDB any more, so the merge gets the whole rate limit. One client for every merge
+        # means a title recommended in several shards has its certification looked up once.
+        merge_client = AsyncTMDBClient(rate_limit=float(get_tmdb_config().get('rate_limit', DEFAULT_RATE_LIMIT)))
+        for index in completed:
+            (result['merged'] if merge_shard(index, count, merge_client) else result['failed']).append(index)
+        update_recommendation_scores()
+        if result['failed']:
+            stage_failed()
+
+    if result['failed']:
+        log_message(f"Shards {sorted(result['failed'])} of {count} did not finish; rerun them with --shard I/{count}.",
+                    level="warning")
+    return result
@@ -0,0 +1,130 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import urlencode
+from config import get_tmdb_config
+from metrics import registry
+
+logging.basicConfig(level=logging.INFO)
+
+DEFAULT_CACHE_PATH = "tmdb_cache.db"
+DEFAULT_MAX_ENTRIES = 50000
+# Seconds a response stays fresh, per endpoint kind; title searches and certifications change far less often than recommendations
+DEFAULT_TTLS = {
+    'search': 30 * 86400,
+    'recommendations': 7 * 86400,
+    'details': 30 * 86400,
+    'default': 86400
+}
+# /movie/{id} or /tv/{id}, fetched with certifications appended
+_DETAILS_PATH = re.compile(r'^/(movie|tv)/\d+$')
+
+class ResponseCache:
+    """
+    Disk-backed TMDB response cache shared across runs.
+    Entries are keyed by endpoint path and query parameters, expire after a per-endpoint TTL and are
+    evicted least-recently-used first once the cache holds more than `max_entries` responses.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES, ttls=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, body TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_responses_accessed_at ON responses (accessed_at)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(path, params=None):
+        """Build a cache key from an endpoint path and its query parameters, ignoring credentials."""
+        params = sorted((k, v) for k, v in (params or {}).items() if k != 'api_key')
+        return f"{path}?{urlencode(params)}" if params else path
+
+    @staticmethod
+    def endpoint_kind(path):
+        """Classify an endpoint path so it can be given its own TTL."""
+        if path.startswith('/search/'):
+            return 'search'
+        if path.endswith('/recommendations'):
+            return 'recommendations'
+        if _DETAILS_PATH.match(path):
+            return 'details'
+        return 'default'
+
+    def get(self, path, params=None):
+        """Return the cached JSON response for an endpoint, or None if it's missing or expired."""
+        key = self.make_key(path, params)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT body, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] < now:
+                if row is not None:
+                    self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                registry.inc('tmdb_cache_requests_total', result='miss', kind=self.endpoint_kind(path),
+                             help="TMDB response cache lookups by result and endpoint kind.")
+                return None
+            self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        registry.inc('tmdb_cache_requests_total', result='hit', kind=self.endpoint_kind(path))
+        return json.loads(row[0])
+
+    def set(self, path, params, data):
+        """Store a JSON response and evict the least recently used entries beyond `max_entries`."""
+        key = self.make_key(path, params)
+        now = time.time()
+        ttl = self.ttls.get(self.endpoint_kind(path), self.ttls['default'])
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, body, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(data), now + ttl, now)
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+            self._conn.commit()
+
+    def stats(self):
+        """Return hit/miss counters and the current number of cached responses."""
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        registry.set('tmdb_cache_entries', size, help="Responses held in the TMDB cache.")
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': size
+        }
+
+# One cache per file, shared by every TMDB helper in the process so counters add up
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_response_cache():
+    """Return the process-wide response cache configured in the 'tmdb.cache' section."""
+    cache_config = get_tmdb_config().get('cache', {}) or {}
+    path = cache_config.get('path', DEFAULT_CACHE_PATH)
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = ResponseCache(
+                path=path,
+                max_entries=int(cache_config.get('max_entries', DEFAULT_MAX_ENTRIES)),
+                ttls=cache_config.get('ttl')
+            )
+        return _caches[path]
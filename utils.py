@@ -1,8 +1,13 @@
 import logging
+import random
+import sys
+import threading
 import time
+import unicodedata
 from functools import wraps
 import re
-import smtplib
+from config import get_email_config
+from metrics import registry
 
 
 # Setup logging with levels
@@ -22,42 +27,292 @@ def log_message(message, level="info"):
 
 
 # Retry Decorator for network calls
-def retry(retries=3, delay=2, backoff=2):
-    """Retry decorator for retrying network calls with exponential backoff."""
+def retry(retries=3, delay=2, backoff=2, max_delay=60):
+    """Retry decorator for retrying network calls with exponential backoff and full jitter."""
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            attempt = 0
-            while attempt < retries:
+            for attempt in range(retries):
                 try:
                     return func(*args, **kwargs)
                 except Exception as e:
                     log_message(f"Attempt {attempt + 1} failed for {func.__name__}: {e}", level="warning")
-                    time.sleep(delay)
-                    attempt += 1
-                    delay *= backoff
+                    if attempt + 1 < retries:
+                        time.sleep(full_jitter(attempt, delay, max_delay, backoff))
             log_message(f"All {retries} retries failed for {func.__name__}", level="error")
             return None
         return wrapper
     return decorator
 
 
+# Resilience layer for individual HTTP calls
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+DEFAULT_RETRIES = 3
+DEFAULT_BASE_DELAY = 0.5
+DEFAULT_MAX_DELAY = 30
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of calling a host whose circuit breaker is open."""
+
+
+def full_jitter(attempt, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY, factor=2):
+    """Exponential backoff with full jitter: a random delay between 0 and min(max_delay, base * factor**attempt)."""
+    return random.uniform(0, min(max_delay, base_delay * factor ** attempt))
+
+
+def _status_code(error):
+    """HTTP status carried by a requests or aiohttp error, if any."""
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status is None and isinstance(getattr(error, 'status', None), int):
+        status = error.status
+    return status
+
+
+def is_retryable(error):
+    """Classify an error: transport failures and throttling/server statuses are retryable, anything else is fatal."""
+    if isinstance(error, CircuitOpenError):
+        return False
+    status = _status_code(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    aiohttp = sys.modules.get('aiohttp')
+    if aiohttp and isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+        return True
+    # requests' connection errors and timeouts are OSErrors too; asyncio's TimeoutError is the builtin since 3.11
+    asyncio = sys.modules.get('asyncio')
+    if asyncio and isinstance(error, asyncio.TimeoutError):
+        return True
+    return isinstance(error, (OSError, TimeoutError))
+
+
+def retry_after(error):
+    """Seconds requested by a Retry-After header on the error's response, if present."""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or getattr(error, 'headers', None) or {}
+    try:
+        return max(float(headers.get('Retry-After')), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker. After `failure_threshold` consecutive retryable failures the circuit opens and
+    calls fail fast for `reset_timeout` seconds; then a single trial call decides whether it closes again.
+    A trial that never reports back (e.g. its task was cancelled) is given up on after another `reset_timeout`.
+    """
+    def __init__(self, host, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.trial_started_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call to the host may go ahead. Returns True if the call is the trial."""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return False
+            now = time.monotonic()
+            if state == 'half_open' and (not self.trial_in_flight or now - self.trial_started_at >= self.reset_timeout):
+                self.trial_in_flight = True
+                self.trial_started_at = now
+                return True
+        _record_metric(self.host, 'rejected')
+        raise CircuitOpenError(f"Circuit open for {self.host}; failing fast")
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                log_message(f"Circuit for {self.host} closed again.")
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def release_trial(self):
+        """Let another call be the trial when this one ended without an outcome."""
+        with self._lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    log_message(f"Circuit for {self.host} opened after {self.failures} failures.", level="warning")
+                self.opened_at = time.monotonic()
+
+
+_breakers = {}
+_retry_metrics = {}
+_resilience_lock = threading.Lock()
+
+
+def get_circuit_breaker(host):
+    """Return the shared circuit breaker for a host."""
+    with _resilience_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+def _record_metric(host, name):
+    with _resilience_lock:
+        counters = _retry_metrics.setdefault(host, {'attempts': 0, 'retries': 0, 'failures': 0, 'giveups': 0, 'rejected': 0})
+        counters[name] += 1
+
+
+def retry_metrics():
+    """Snapshot of retry counters and circuit breaker state per host."""
+    with _resilience_lock:
+        snapshot = {host: dict(counters) for host, counters in _retry_metrics.items()}
+        breakers = dict(_breakers)
+    for host, breaker in breakers.items():
+        snapshot.setdefault(host, {'attempts': 0, 'retries': 0, 'failures': 0, 'giveups': 0, 'rejected': 0})
+        snapshot[host]['circuit'] = breaker.state
+    return snapshot
+
+
+def _describe(error):
+    """Short error description for logs; request URLs may carry API keys, so HTTP errors show only their status."""
+    status = _status_code(error)
+    return f"HTTP {status}" if status is not None else f"{type(error).__name__}: {error}"
+
+
+# Retry counters and breaker states are included in metrics snapshots
+registry.register_collector('retries', retry_metrics)
+
+
+def _handle_failure(error, host, breaker, attempt, retries, base_delay, max_delay):
+    """Record a failed attempt and return the delay before the next one, or None to give up."""
+    retryable = is_retryable(error)
+    if retryable:
+        _record_metric(host, 'failures')
+    if breaker:
+        # Throttling and client errors still prove the host is up; only outages count against the breaker
+        if retryable and _status_code(error) != 429:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+    if not retryable or attempt >= retries:
+        _record_metric(host, 'giveups')
+        return None
+    _record_metric(host, 'retries')
+    delay = retry_after(error)
+    return delay if delay is not None else full_jitter(attempt, base_delay, max_delay)
+
+
+def call_with_retry(func, *args, host=None, retries=DEFAULT_RETRIES, base_delay=DEFAULT_BASE_DELAY,
+                    max_delay=DEFAULT_MAX_DELAY, **kwargs):
+    """
+    Call `func(*args, **kwargs)` for a single HTTP request, retrying retryable errors with full-jitter backoff
+    (or the server's Retry-After) behind the host's circuit breaker. Fatal errors are raised immediately.
+    """
+    breaker = get_circuit_breaker(host) if host else None
+    for attempt in range(retries + 1):
+        trial = breaker.before_call() if breaker else False
+        _record_metric(host, 'attempts')
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            delay = _handle_failure(e, host, breaker, attempt, retries, base_delay, max_delay)
+            if delay is None:
+                raise
+            log_message(f"Request to {host} failed ({_describe(e)}); retry {attempt + 1}/{retries} in {delay:.1f}s", level="warning")
+            time.sleep(delay)
+            continue
+        except BaseException:
+            # Cancelled or interrupted mid-call; don't leave the host blocked behind a trial that never finished
+            if trial:
+                breaker.release_trial()
+            raise
+        if breaker:
+            breaker.record_success()
+        return result
+
+
+async def async_call_with_retry(func, *args, host=None, retries=DEFAULT_RETRIES, base_delay=DEFAULT_BASE_DELAY,
+                                max_delay=DEFAULT_MAX_DELAY, on_retry=None, **kwargs):
+    """
+    Asyncio variant of call_with_retry: awaits `func(*args, **kwargs)` and backs off with asyncio.sleep so the
+    event loop keeps running. `on_retry(error, delay)` is called before each backoff.
+    """
+    import asyncio
+    breaker = get_circuit_breaker(host) if host else None
+    for attempt in range(retries + 1):
+        trial = breaker.before_call() if breaker else False
+        _record_metric(host, 'attempts')
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            delay = _handle_failure(e, host, breaker, attempt, retries, base_delay, max_delay)
+            if delay is None:
+                raise
+            log_message(f"Request to {host} failed ({_describe(e)}); retry {attempt + 1}/{retries} in {delay:.1f}s", level="warning")
+            if on_retry:
+                on_retry(e, delay)
+            await asyncio.sleep(delay)
+            continue
+        except BaseException:
+            # Cancelled or interrupted mid-call; don't leave the host blocked behind a trial that never finished
+            if trial:
+                breaker.release_trial()
+            raise
+        if breaker:
+            breaker.record_success()
+        return result
+
+
 # Data Cleaning Utilities
+# Precompiled once; standardize_title runs for every library item and every recommendation
+_YEAR_SUFFIX = re.compile(r'\s*\(\d{4}\)\s*$')
+_NON_WORD = re.compile(r'[^\w\s]')
+_WHITESPACE = re.compile(r'\s+')
+
+
 def standardize_title(title):
     """Standardize media titles by removing unwanted characters and adjusting format for search accuracy."""
+    # Fold accents and compatibility forms ("Amélie", "ﬁlm") onto plain letters, then ignore case
+    title = unicodedata.normalize('NFKD', title or '')
+    title = ''.join(char for char in title if not unicodedata.combining(char)).casefold()
     # Remove special characters and trailing year info
-    title = re.sub(r'\(\d{4}\)$', '', title)  # Remove year if in the format "(YYYY)"
-    title = re.sub(r'[^\w\s]', '', title)  # Remove non-alphanumeric characters
-    title = title.strip()
+    title = _YEAR_SUFFIX.sub('', title)  # Remove year if in the format "(YYYY)"
+    title = _NON_WORD.sub('', title)  # Remove non-alphanumeric characters
+    title = _WHITESPACE.sub(' ', title).strip()
     return title
 
 
 def get_email_smtp_client():
-    """Helper to get an SMTP client based on configuration settings."""
-    smtp_config = config["email"]
-    server = smtplib.SMTP(smtp_config["smtp_server"], smtp_config["smtp_port"])
-    server.starttls()
-    server.login(smtp_config["sender"], smtp_config["password"])
+    """Helper to get an authenticated SMTP client based on configuration settings."""
+    import smtplib
+    smtp_config = get_email_config()
+    server = smtplib.SMTP(smtp_config["smtp_server"], smtp_config["smtp_port"], timeout=smtp_config.get("timeout", 30))
+    try:
+        if smtp_config.get("use_tls", True):
+            server.starttls()
+        # Local relays and test servers may not require authentication
+        if smtp_config.get("password"):
+            server.login(smtp_config.get("username", smtp_config["sender"]), smtp_config["password"])
+    except Exception:
+        server.close()
+        raise
     return server
 
 